@@ -0,0 +1,317 @@
+"""
+Micro-benchmarks for the idle screen's per-minute tick, run off-Pi against a fake LCD, then end to end scenarios
+driving the whole menu through simulated hardware.
+
+    python bench.py              # everything
+    python bench.py tick -n 5000 # just the benchmarks with 'tick' in their name
+    python bench.py e2e          # just the end to end scenarios
+
+Each scenario has a budget for what it may measure, anything over it is reported and the exit status is 1, so this
+doubles as a regression gate for performance changes.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import timeit
+from datetime import datetime, timedelta
+from time import perf_counter
+from typing import Awaitable, Callable
+
+from fakes import FakeHD44780, FakeKeyMatrix, fake_ddcs, taps
+from fmt import fit, spread, time_str, wind_dir
+from lcd import LCD, Msg
+from patterns import AM, FAHRENHEIT, PM, SUN, patterns
+
+BENCHMARKS: dict[str, Callable[[], Callable[[], object]]] = {}
+SCENARIOS: dict[str, Callable[..., Awaitable[dict]]] = {}
+BUDGETS: dict[str, dict[str, float]] = {}
+# a day's worth of minutes so cached formatters are measured across misses as well as hits
+MINUTES = [datetime(2024, 1, 1) + timedelta(minutes=m) for m in range(24 * 60)]
+
+
+def bench(name: str):
+    """Registers a setup function that returns the zero argument callable to time"""
+
+    def register(setup: Callable[[], Callable[[], object]]):
+        BENCHMARKS[name] = setup
+        return setup
+
+    return register
+
+
+def scenario(name: str, budget: dict[str, float] = None):
+    """Registers an end to end scenario, a coroutine function taking realtime and returning what it measured. budget
+    is the most each of those measurements may be."""
+
+    def register(run: Callable[..., Awaitable[dict]]):
+        SCENARIOS[name] = run
+        BUDGETS[name] = budget or {}
+        return run
+
+    return register
+
+
+def legacy_wind_dir(degrees: int) -> str:
+    directions = ['N', 'NNE', 'NE', 'ENE', 'E', 'ESE', 'SE', 'SSE', 'S', 'SSW', 'SW', 'WSW', 'W', 'WNW', 'NW', 'NNW']
+    return next(d for i, d in enumerate(directions) if abs(degrees % 360 - (i * 22.5)) % (360 - 11.25) < 11.25)
+
+
+def legacy_time_str(dt: datetime) -> str:
+    return f"{dt.strftime('%I:%M').lstrip('0')}{AM if dt.strftime('%p') == 'AM' else PM}"
+
+
+def cycle(items: list) -> Callable[[], object]:
+    i = 0
+
+    def step():
+        nonlocal i
+        i = (i + 1) % len(items)
+        return items[i]
+
+    return step
+
+
+@bench('wind_dir legacy')
+def _():
+    step = cycle(list(range(360)))
+    return lambda: legacy_wind_dir(step())
+
+
+@bench('wind_dir table')
+def _():
+    step = cycle(list(range(360)))
+    return lambda: wind_dir(step())
+
+
+@bench('time_str strftime')
+def _():
+    step = cycle(MINUTES)
+    return lambda: legacy_time_str(step())
+
+
+@bench('time_str cached')
+def _():
+    step = cycle(MINUTES)
+    return lambda: time_str(step())
+
+
+@bench('layout weather line')
+def _():
+    step = cycle(MINUTES)
+    return lambda: fit(spread(time_str(step()), f'71{FAHRENHEIT}', 'Clouds'))
+
+
+@bench('tick weather frame')
+def _():
+    """What the weather frame does each minute: lay out the clock line and draw it"""
+    lcd = LCD(FakeHD44780())
+    step = cycle(MINUTES)
+    line_two = fit(spread(f"5mph {wind_dir(90)}", f"{SUN}6:41{PM}"))
+
+    def tick():
+        lcd.msg(Msg(fit(spread(time_str(step()), f'71{FAHRENHEIT}', 'Clouds')), line_two))
+
+    return tick
+
+
+@bench('render compiled msg')
+def _():
+    """Redrawing already compiled messages, alternating so every call has cells to write"""
+    lcd = LCD(FakeHD44780())
+    step = cycle([Msg(f'{time_str(MINUTES[m])} 71{FAHRENHEIT} Clouds', f'5mph E {SUN}6:41{PM}') for m in range(2)])
+    return lambda: lcd.msg(step())
+
+
+@bench('render glyph churn')
+def _():
+    """Messages that between them need more glyphs than there are CGRAM slots"""
+    lcd = LCD(FakeHD44780())
+    step = cycle([Msg(''.join(p.char for p in patterns[i:i + 6])) for i in range(0, len(patterns) - 5, 2)])
+    return lambda: lcd.msg(step())
+
+
+@bench('marquee step hardware')
+def _():
+    lcd = LCD(FakeHD44780())
+    lcd.msg(Msg('a notification too long to fit', ''))
+    return lcd.step
+
+
+@bench('marquee step software')
+def _():
+    lcd = LCD(FakeHD44780())
+    lcd.msg(Msg('a notification far too long to fit in DDRAM either', 'static'))
+    return lcd.step
+
+
+class Simulation:
+    """The whole menu on simulated hardware: a display that takes as long as the real one to write to, a key matrix
+    replaying traces and monitors that answer with some latency"""
+
+    def __init__(self, monitors: int = 2, ddc_latency: float = .02, realtime: bool = True):
+        # imported here so the micro-benchmarks don't pay for the whole app
+        from kvm import KVM
+        from main_menu import MainMenu
+        from monitor_cache import StateCache
+        from pad import Keypad
+
+        self.display = FakeHD44780(realtime=realtime)
+        self.matrix = FakeKeyMatrix()
+        self.keypad = Keypad(self.matrix)
+        self.ddcs = fake_ddcs(monitors, ddc_latency)
+        kvm = KVM(self.ddcs, StateCache(os.path.join(tempfile.mkdtemp(), 'monitor_cache.json')))
+        self.menu = MainMenu(self.keypad, lcd=LCD(self.display), kvm=kvm)
+
+        # when each key went down and each frame reached the glass
+        self.pressed: list[float] = []
+        self.drawn: list[float] = []
+        record = self.matrix.events.keypad_eventqueue_record
+
+        def pressed(key_number: int, current: bool):
+            if current:
+                self.pressed.append(perf_counter())
+            record(key_number, current)
+
+        self.matrix.events.keypad_eventqueue_record = pressed
+        on_draw = self.menu.lcd.on_draw
+
+        def drawn():
+            self.drawn.append(perf_counter())
+            on_draw()
+
+        self.menu.lcd.on_draw = drawn
+        self._tasks: list[asyncio.Task] = []
+
+    async def __aenter__(self):
+        self._tasks = [asyncio.create_task(self.keypad.run()), asyncio.create_task(self.menu.run())]
+        await asyncio.sleep(.1)
+        self.display.reset_counters()
+        for ddc in self.ddcs:
+            ddc.monitor.sets = ddc.monitor.gets = 0
+        return self
+
+    async def __aexit__(self, *_):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.menu.aclose()
+
+    async def play(self, trace: list, settle: float = .5):
+        await asyncio.to_thread(self.matrix.play(trace).join)
+        await asyncio.sleep(settle)
+
+    def glass_latency(self) -> list[float]:
+        """For every key press, how long until the next frame was drawn"""
+        latencies = []
+        for press in self.pressed:
+            if (drawn := next((d for d in self.drawn if d >= press), None)) is not None:
+                latencies.append(drawn - press)
+        return latencies
+
+    def hardware(self) -> dict:
+        return {
+            'lcd chars': self.display.writes,
+            'lcd commands': self.display.commands,
+            'lcd busy ms': self.display.busy * 1000,
+            'ddc sets': sum(ddc.monitor.sets for ddc in self.ddcs),
+            'ddc gets': sum(ddc.monitor.gets for ddc in self.ddcs)
+        }
+
+
+def percentiles(values: list[float]) -> dict:
+    values = sorted(values)
+    if not values:
+        return {}
+    return {
+        'p50 ms': values[len(values) // 2] * 1000,
+        'p95 ms': values[min(len(values) - 1, int(len(values) * .95))] * 1000,
+        'max ms': values[-1] * 1000
+    }
+
+
+def over_budget(name: str, results: dict) -> list[str]:
+    return [
+        f'{key} {results[key]:.2f} > {limit}' for key, limit in BUDGETS[name].items()
+        if key not in results or results[key] > limit
+    ]
+
+
+# a frame is at most 50ms apart at 20fps, every set reaches both monitors once
+@scenario('e2e keypress trace', {'p95 ms': 100, 'lcd chars': 400, 'ddc sets': 6})
+async def _(realtime: bool = True):
+    """Through the menus, setting volume and brightness and switching inputs"""
+    async with Simulation(realtime=realtime) as sim:
+        await sim.play(taps(['8', 'A', '5', '0', '#', 'D', 'C', 'B', '7', '#', '2', '8', '2'], start=.1, gap=.3))
+        return {
+            'presses': len(sim.pressed),
+            **percentiles(sim.glass_latency()),
+            'key to action mean ms': sim.menu.keymap.latency.snapshot()['mean'] * 1000,
+            **sim.hardware()
+        }
+
+
+# rate limiting and coalescing keep a flood from turning into a flood of writes
+@scenario('e2e message flood', {'lcd chars': 60, 'ddc sets': 0})
+async def _(realtime: bool = True):
+    """Many clients posting batches of messages at once, then a few seconds of showing them"""
+    import httpx
+    from fastapi import FastAPI
+
+    import server
+
+    async with Simulation(realtime=realtime) as sim:
+        app = FastAPI(menu=sim.menu, keypad=sim.keypad)
+        app.include_router(server.router)
+
+        async def client(i: int) -> list[dict]:
+            transport = httpx.ASGITransport(app, client=(f'10.0.0.{i}', 1234))
+            async with httpx.AsyncClient(transport=transport, base_url='http://monitor') as http:
+                batch = [{'lines': [f'client {i}', f'message {n}'], 'duration': .5} for n in range(20)]
+                return (await http.post('/batch', json=batch)).json()
+
+        started = perf_counter()
+        results = [r for rs in await asyncio.gather(*(client(i) for i in range(32))) for r in rs]
+        elapsed = perf_counter() - started
+        await asyncio.sleep(3)
+        return {
+            'messages': len(results),
+            'per second': len(results) / elapsed,
+            'accepted': sum('error' not in r for r in results),
+            'rejected': sum('error' in r for r in results),
+            'frames drawn': len(sim.drawn),
+            **sim.hardware()
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('match', nargs='?', default='', help='only run benchmarks whose name contains this')
+    parser.add_argument('-n', '--number', type=int, default=20_000, help='calls per repeat')
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    for name, setup in BENCHMARKS.items():
+        if args.match not in name:
+            continue
+        fun = setup()
+        best = min(timeit.repeat(fun, number=args.number, repeat=args.repeat)) / args.number
+        print(f'{name:<24}{best * 1e6:>10.2f} µs/call')
+
+    failed = False
+    for name, run in SCENARIOS.items():
+        if args.match not in name:
+            continue
+        print(name)
+        results = asyncio.run(run())
+        for key, value in results.items():
+            print(f'  {key:<22}{value:>10.2f}' if isinstance(value, float) else f'  {key:<22}{value:>10}')
+        for over in over_budget(name, results):
+            failed = True
+            print(f'  over budget: {over}')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
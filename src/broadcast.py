@@ -0,0 +1,39 @@
+import asyncio
+import json
+from typing import AsyncIterator
+
+KEEPALIVE = b': keepalive\n\n'
+
+
+class Broadcast:
+    """Fans the latest event out to any number of Server-Sent Events listeners.
+
+    Publishing encodes the event once and resolves a single shared future, so its cost doesn't depend on how many
+    clients are connected. Listeners only ever need the latest state, a slow one skips straight to it."""
+
+    def __init__(self):
+        self.latest: bytes | None = None
+        self.version = 0
+        self._next: asyncio.Future | None = None
+
+    def publish(self, event: dict):
+        self.latest = f'data: {json.dumps(event, separators=(",", ":"))}\n\n'.encode()
+        self.version += 1
+        if self._next and not self._next.done():
+            self._next.set_result(None)
+        self._next = None
+
+    async def subscribe(self, keepalive: float = 15) -> AsyncIterator[bytes]:
+        seen = 0
+        while True:
+            if self.version == seen:
+                if self._next is None:
+                    self._next = asyncio.get_running_loop().create_future()
+                try:
+                    # shielded so one client going away doesn't cancel the future everyone else is waiting on
+                    await asyncio.wait_for(asyncio.shield(self._next), keepalive)
+                except asyncio.TimeoutError:
+                    yield KEEPALIVE
+                    continue
+            seen = self.version
+            yield self.latest
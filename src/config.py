@@ -0,0 +1,325 @@
+"""
+pinout.json and menu.json, parsed and validated once and shared by everything. ConfigWatcher reloads them whenever
+either changes on disk and tells each subscriber about only the sections it cares about.
+
+Validation is plain dataclasses rather than pydantic, since the LCD needs its pins before the splash and pydantic alone
+takes longer to import than the splash is allowed to.
+"""
+import asyncio
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import struct
+import types
+import typing
+from dataclasses import MISSING, dataclass, field, fields, is_dataclass
+from pathlib import Path
+from typing import Any, Callable
+
+ROOT = Path(__file__).resolve().parent.parent
+PINOUT_PATH = ROOT / 'pinout.json'
+MENU_PATH = ROOT / 'menu.json'
+IDLE_UNLOAD = 10 * 60  # seconds a submenu can go unseen before it's dropped, to be rebuilt when next shown
+POLL_INTERVAL = 2  # checking mtimes, where inotify isn't available
+DEBOUNCE = .2  # editors often write a file in more than one go
+
+# linux/inotify.h
+IN_CLOSE_WRITE = 0x08
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len, then len bytes of name
+
+
+class ConfigError(ValueError):
+    pass
+
+
+@dataclass(frozen=True)
+class DisplayPins:
+    RS: int
+    EN: int
+    D4: int
+    D5: int
+    D6: int
+    D7: int
+
+
+@dataclass(frozen=True)
+class KeypadPins:
+    rows: list[int]
+    cols: list[int]
+
+
+@dataclass(frozen=True)
+class DisplayInput:
+    id: str  # VCP 0x60 value in hex
+    label: str
+
+    def __post_init__(self):
+        int(self.id, 16)
+
+
+@dataclass(frozen=True)
+class KVMPins:
+    input: int = field(metadata={'key': 'in'})
+    out: int
+
+
+@dataclass(frozen=True)
+class SceneConfig:
+    input: str | None = None
+    brightness: int | None = None
+    volume: int | None = None
+
+    def __post_init__(self):
+        for name in ('brightness', 'volume'):
+            if not 0 <= (getattr(self, name) or 0) <= 100:
+                raise ValueError(f'{name} must be 0-100')
+
+
+@dataclass(frozen=True)
+class WeatherConfig:
+    """Anything left out comes from the environment variables the service file sets"""
+    key: str | None = field(default_factory=lambda: os.environ.get('OPEN_WEATHER_API_KEY'))
+    lat: str | None = field(default_factory=lambda: os.environ.get('LAT'))
+    lon: str | None = field(default_factory=lambda: os.environ.get('LON'))
+    url: str | None = field(default_factory=lambda: os.environ.get('OPEN_WEATHER_URL'))
+
+
+@dataclass(frozen=True)
+class TelemetryConfig:
+    webhook: str | None = None
+
+
+@dataclass(frozen=True)
+class SubmenuConfig:
+    frame: str  # module.Class
+    lines: list[str] = field(default_factory=list)
+    arrows: bool = False
+
+
+@dataclass(frozen=True)
+class MenuConfig:
+    submenus: list[SubmenuConfig]
+    idle_unload: float = IDLE_UNLOAD
+
+    def __post_init__(self):
+        if not self.submenus:
+            raise ValueError('needs at least one submenu')
+
+
+DEFAULT_MENU = MenuConfig([SubmenuConfig('weather.Weather'), SubmenuConfig('frame.MenuFrame', ['Main Menu'], True)])
+
+
+@dataclass(frozen=True)
+class Config:
+    display_bcm_pins: DisplayPins
+    keypad_bcm_pins: KeypadPins
+    displays: list[DisplayInput] | None = None  # None to probe each monitor for its inputs
+    kvm: KVMPins | None = None
+    scenes: dict[str, SceneConfig] = field(default_factory=dict)
+    ddc_buses: list[int] | None = None  # None to find them
+    glyph_packs: list[str] = field(default_factory=list)
+    weather: WeatherConfig = field(default_factory=WeatherConfig)
+    telemetry: TelemetryConfig = field(default_factory=TelemetryConfig)
+    simulate: dict[str, dict[str, Any]] = field(default_factory=dict)  # device to its fake's arguments, see fakes.py
+    menu: MenuConfig = DEFAULT_MENU  # from menu.json
+
+    @staticmethod
+    def path(name: str) -> Path:
+        """Paths in the config are relative to the repo, wherever the app was started from"""
+        return ROOT / name
+
+
+SECTIONS = frozenset(f.name for f in fields(Config))
+
+
+def convert(kind, value, where: str):
+    """value from JSON as kind, raising ConfigError saying where it's wrong"""
+    if is_dataclass(kind):
+        if not isinstance(value, dict):
+            raise ConfigError(f'{where}: expected an object, got {value!r}')
+        hints = typing.get_type_hints(kind)
+        args, keys = {}, set()
+        for f in fields(kind):
+            key = f.metadata.get('key', f.name)
+            keys.add(key)
+            if key in value:
+                args[f.name] = convert(hints[f.name], value[key], f'{where}.{key}')
+            elif f.default is MISSING and f.default_factory is MISSING:
+                raise ConfigError(f'{where}: missing {key}')
+        if unknown := value.keys() - keys:
+            raise ConfigError(f'{where}: unknown {", ".join(sorted(unknown))}')
+        try:
+            return kind(**args)
+        except (TypeError, ValueError) as e:
+            raise ConfigError(f'{where}: {e}') from None
+
+    origin, args = typing.get_origin(kind), typing.get_args(kind)
+    if origin in (typing.Union, types.UnionType):
+        if value is None and type(None) in args:
+            return None
+        return convert(next(a for a in args if a is not type(None)), value, where)
+    if origin is list and isinstance(value, list):
+        return [convert(args[0], v, f'{where}[{i}]') for i, v in enumerate(value)]
+    if origin is dict and isinstance(value, dict):
+        return {k: convert(args[1], v, f'{where}.{k}') for k, v in value.items()}
+    if kind is Any:
+        return value
+    if kind is float and type(value) is int:
+        return float(value)
+    if origin is None and type(value) is kind:
+        return value
+    raise ConfigError(f'{where}: expected {getattr(kind, "__name__", kind)}, got {value!r}')
+
+
+def load(pinout: Path = PINOUT_PATH, menu: Path = MENU_PATH) -> Config:
+    try:
+        data = json.loads(pinout.read_text())
+        menu_data = json.loads(menu.read_text()) if menu.exists() else None
+    except json.JSONDecodeError as e:
+        raise ConfigError(str(e)) from None
+    config = convert(Config, data, pinout.name)
+    if menu_data is not None:
+        config = Config(**{**config.__dict__, 'menu': convert(MenuConfig, menu_data, menu.name)})
+    return config
+
+
+_current: Config | None = None
+
+
+def current() -> Config:
+    """The config as last loaded, loading it the first time"""
+    global _current
+    if _current is None:
+        _current = load()
+    return _current
+
+
+def lookup(cfg: Config, key: str):
+    """A section, or something inside one by a dotted path, e.g. simulate.lcd or weather.key"""
+    value = cfg
+    for part in key.split('.'):
+        value = value.get(part) if isinstance(value, dict) else getattr(value, part, None)
+    return value
+
+
+def changed(old: Config, new: Config) -> set[str]:
+    return {name for name in SECTIONS if getattr(old, name) != getattr(new, name)}
+
+
+class ConfigWatcher:
+    """Reloads the config whenever pinout.json or menu.json change. Each subscriber is called with the new config
+    once per reload that changed anything it subscribed to, so only the affected parts of the app are rebuilt. A file
+    that doesn't parse or validate is logged and ignored, leaving the last good config in place."""
+
+    def __init__(self, pinout: Path = PINOUT_PATH, menu: Path = MENU_PATH):
+        self.pinout = pinout
+        self.menu = menu
+        self.subscribers: list[tuple[tuple[str, ...], Callable[[Config], Any]]] = []
+        self.reloads = 0
+
+    def subscribe(self, keys: str | tuple[str, ...], callback: Callable[[Config], Any]):
+        """keys are sections or dotted paths into them, see lookup()"""
+        keys = (keys,) if isinstance(keys, str) else keys
+        if unknown := {key.split('.')[0] for key in keys} - SECTIONS:
+            raise ValueError(f'no config sections {", ".join(unknown)}')
+        self.subscribers.append((keys, callback))
+
+    def reload(self) -> set[str]:
+        global _current
+        try:
+            new = load(self.pinout, self.menu)
+        except (OSError, ConfigError) as e:
+            logging.warning(f'ignoring config change: {e}')
+            return set()
+        old, _current = current(), new
+        if not (sections := changed(old, new)):
+            return sections
+        self.reloads += 1
+        logging.info(f'config changed: {", ".join(sorted(sections))}')
+        for keys, callback in self.subscribers:
+            if any(lookup(old, key) != lookup(new, key) for key in keys):
+                try:
+                    callback(new)
+                except Exception:
+                    logging.exception(f'applying a change to {", ".join(keys)} failed')
+        return sections
+
+    async def run(self):
+        # anything changed since the config was first loaded
+        self.reload()
+        try:
+            fd = inotify(self.pinout.parent, self.menu.parent)
+        except OSError as e:
+            logging.info(f'inotify unavailable ({e}), polling the config for changes')
+            return await self._poll()
+        try:
+            await self._watch(fd)
+        finally:
+            os.close(fd)
+
+    async def _watch(self, fd: int):
+        loop = asyncio.get_running_loop()
+        names = {self.pinout.name, self.menu.name}
+        ready = asyncio.Event()
+        loop.add_reader(fd, ready.set)
+        try:
+            while True:
+                await ready.wait()
+                ready.clear()
+                if names & set(read_events(fd)):
+                    # whatever else arrives meanwhile is part of the same save
+                    await asyncio.sleep(DEBOUNCE)
+                    read_events(fd)
+                    ready.clear()
+                    self.reload()
+        finally:
+            loop.remove_reader(fd)
+
+    async def _poll(self):
+        def mtimes():
+            return [p.stat().st_mtime_ns if p.exists() else None for p in (self.pinout, self.menu)]
+
+        last = mtimes()
+        while True:
+            await asyncio.sleep(POLL_INTERVAL)
+            if (now := mtimes()) != last:
+                last = now
+                self.reload()
+
+
+def inotify(*directories: Path) -> int:
+    """A non-blocking inotify fd for files in directories being written or moved in. Watching the directory rather than
+    the file catches editors that save by writing a new file and renaming it over the old one."""
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    if not hasattr(libc, 'inotify_init1'):
+        raise OSError('no inotify in libc')
+    fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if fd < 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    for directory in set(directories):
+        if libc.inotify_add_watch(fd, str(directory).encode(), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE) < 0:
+            errno = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(errno, os.strerror(errno))
+    return fd
+
+
+def read_events(fd: int) -> list[str]:
+    """Names of the files in every event waiting on fd"""
+    names = []
+    while True:
+        try:
+            data = os.read(fd, 4096)
+        except BlockingIOError:
+            return names
+        offset = 0
+        while offset < len(data):
+            _, _, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            names.append(data[offset:offset + length].rstrip(b'\0').decode(errors='replace'))
+            offset += length
@@ -0,0 +1,223 @@
+import fcntl
+import logging
+import os
+import re
+import shutil
+import subprocess
+import threading
+from glob import glob
+from time import monotonic, sleep
+
+I2C_SLAVE = 0x0703  # linux/i2c-dev.h
+DDC_ADDR = 0x37
+EDID_ADDR = 0x50
+EDID_LEN = 128
+EDID_HEADER = bytes([0, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0])
+HOST_ADDR = 0x51
+DISPLAY_ADDR = DDC_ADDR << 1
+REPLY_ADDR = 0x50  # checksums on replies are seeded with the "virtual host" address
+
+GET_VCP = 0x01
+GET_VCP_REPLY = 0x02
+SET_VCP = 0x03
+LENGTH_FLAG = 0x80
+VCP_REPLY_LEN = 11
+
+# DDC/CI timing, the display ignores anything sent sooner
+REPLY_DELAY = .04
+COMMAND_SPACING = .05
+
+INPUT_SOURCE = 0x60
+BRIGHTNESS = 0x10
+VOLUME = 0x62
+
+
+class DDCError(Exception):
+    pass
+
+
+def checksum(seed: int, data: bytes) -> int:
+    for b in data:
+        seed ^= b
+    return seed
+
+
+def _packet(*payload: int) -> bytes:
+    body = bytes([HOST_ADDR, LENGTH_FLAG | len(payload), *payload])
+    return body + bytes([checksum(DISPLAY_ADDR, body)])
+
+
+def set_vcp_packet(code: int, value: int) -> bytes:
+    return _packet(SET_VCP, code, value >> 8 & 0xff, value & 0xff)
+
+
+def get_vcp_packet(code: int) -> bytes:
+    return _packet(GET_VCP, code)
+
+
+def parse_vcp_reply(code: int, reply: bytes) -> tuple[int, int]:
+    """Returns (current, max) out of a Get VCP Feature reply"""
+    if len(reply) < VCP_REPLY_LEN:
+        raise DDCError(f'short reply for 0x{code:02x}: {reply.hex()}')
+    if checksum(REPLY_ADDR, reply[:VCP_REPLY_LEN - 1]) != reply[VCP_REPLY_LEN - 1]:
+        raise DDCError(f'bad checksum for 0x{code:02x}: {reply.hex()}')
+    _, _, opcode, result, reply_code, _, max_hi, max_lo, cur_hi, cur_lo, _ = reply[:VCP_REPLY_LEN]
+    if opcode != GET_VCP_REPLY or reply_code != code:
+        raise DDCError(f'unexpected reply for 0x{code:02x}: {reply.hex()}')
+    if result:
+        raise DDCError(f'VCP 0x{code:02x} unsupported')
+    return cur_hi << 8 | cur_lo, max_hi << 8 | max_lo
+
+
+def edid_serial(edid: bytes) -> str:
+    """Manufacturer, product code and serial number, which is enough to tell monitors apart"""
+    if not edid.startswith(EDID_HEADER):
+        return edid.decode('utf-8', errors='replace').strip()  # not a raw EDID, e.g. ddcutil's detect summary
+    mfg = int.from_bytes(edid[8:10], 'big')
+    mfg = ''.join(chr(ord('A') - 1 + (mfg >> shift & 0x1f)) for shift in (10, 5, 0))
+    product = int.from_bytes(edid[10:12], 'little')
+    serial = str(int.from_bytes(edid[12:16], 'little'))
+    for offset in range(54, EDID_LEN, 18):  # display descriptors, 0xff is the serial number string
+        if edid[offset:offset + 4] == bytes([0, 0, 0, 0xff]):
+            serial = edid[offset + 5:offset + 18].decode('ascii', errors='replace').strip()
+    return f'{mfg}-{product:04x}-{serial}'
+
+
+class DDCBackend:
+    def edid(self) -> bytes:
+        pass
+
+    def set_vcp(self, code: int, value: int):
+        pass
+
+    def get_vcp(self, code: int) -> tuple[int, int]:
+        pass
+
+    def capabilities(self) -> str:
+        pass
+
+
+class DdcutilBackend(DDCBackend):
+    """Shells out to ddcutil for every command. Slow, but works on any bus ddcutil can find."""
+
+    def __init__(self, bus: int = None):
+        self.bus = bus
+        self._args = ['ddcutil'] if bus is None else ['ddcutil', '--bus', str(bus)]
+
+    def _run(self, *args: str) -> str:
+        return subprocess.run([*self._args, *args], stdout=subprocess.PIPE).stdout.decode('utf-8')
+
+    def edid(self) -> bytes:
+        # ddcutil only dumps the raw EDID in its verbose output, the terse Monitor: line identifies it just as well
+        detect = self._run('detect', '--terse')
+        return next((line.strip().encode() for line in detect.splitlines() if 'Monitor:' in line), b'')
+
+    def set_vcp(self, code: int, value: int):
+        self._run('setvcp', f'0x{code:02x}', str(value), '--noverify')
+
+    def get_vcp(self, code: int) -> tuple[int, int]:
+        # e.g. "VCP 10 C 50 100" for continuous, "VCP 60 SNC x0f" for non-continuous
+        terse = self._run('getvcp', f'0x{code:02x}', '--terse').strip().split(' ')
+        match terse[2:]:
+            case ['C', cur, max_]:
+                return int(cur), int(max_)
+            case ['SNC', cur]:
+                return int(cur.lstrip('x'), 16), 0
+        raise DDCError(f"couldn't parse getvcp 0x{code:02x}: {' '.join(terse)}")
+
+    def capabilities(self) -> str:
+        return self._run('capabilities')
+
+
+class I2CDevice:
+    """/dev/i2c-N opened once and pointed at a single address"""
+
+    def __init__(self, bus: int, address: int = DDC_ADDR):
+        self.fd = os.open(f'/dev/i2c-{bus}', os.O_RDWR)
+        fcntl.ioctl(self.fd, I2C_SLAVE, address)
+
+    def write(self, data: bytes):
+        os.write(self.fd, data)
+
+    def read(self, n: int) -> bytes:
+        return os.read(self.fd, n)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class I2CBackend(DDCBackend):
+    """Speaks DDC/CI straight to the i2c bus, so a VCP set is a single ~1 ms transaction instead of a process spawn
+    plus ddcutil's bus detection. Commands are serialized and spaced out as the spec requires."""
+
+    def __init__(self, device, bus: int = None, edid_device=None):
+        self.device = device
+        self.bus = bus
+        self.edid_device = edid_device
+        self._lock = threading.Lock()
+        self._ready = 0.  # when the display will next accept a command
+
+    @classmethod
+    def open(cls, bus: int) -> 'I2CBackend':
+        return cls(I2CDevice(bus), bus, I2CDevice(bus, EDID_ADDR))
+
+    def _wait(self):
+        delay = self._ready - monotonic()
+        if delay > 0:
+            sleep(delay)
+
+    def edid(self) -> bytes:
+        if self.edid_device is None:
+            return b''
+        with self._lock:
+            self.edid_device.write(b'\x00')
+            return self.edid_device.read(EDID_LEN)
+
+    def set_vcp(self, code: int, value: int):
+        with self._lock:
+            self._wait()
+            self.device.write(set_vcp_packet(code, value))
+            self._ready = monotonic() + COMMAND_SPACING
+
+    def get_vcp(self, code: int) -> tuple[int, int]:
+        with self._lock:
+            self._wait()
+            self.device.write(get_vcp_packet(code))
+            sleep(REPLY_DELAY)
+            reply = self.device.read(VCP_REPLY_LEN)
+            self._ready = monotonic() + COMMAND_SPACING
+        return parse_vcp_reply(code, reply)
+
+    def capabilities(self) -> str:
+        # the capabilities string comes back in dozens of fragments; it's only read once so leave it to ddcutil
+        return DdcutilBackend(self.bus).capabilities()
+
+
+def open_backend(bus: int = None) -> DDCBackend:
+    if bus is not None and os.path.exists(f'/dev/i2c-{bus}'):
+        try:
+            return I2CBackend.open(bus)
+        except OSError as e:
+            logging.warning(f'falling back to ddcutil, could not open /dev/i2c-{bus}: {e!r}')
+    return DdcutilBackend(bus)
+
+
+def discover_buses() -> list[int]:
+    """Buses with an EDID answering at 0x50, the same test ddcutil uses to find monitors"""
+    buses = []
+    for path in glob('/dev/i2c-*'):
+        bus = int(path.rsplit('-', 1)[1])
+        try:
+            device = I2CDevice(bus, EDID_ADDR)
+            try:
+                device.write(b'\x00')
+                if device.read(len(EDID_HEADER)) == EDID_HEADER:
+                    buses.append(bus)
+            finally:
+                device.close()
+        except OSError:
+            continue
+
+    if not buses and shutil.which('ddcutil'):
+        buses = [int(bus) for bus in re.findall(r'/dev/i2c-(\d+)', DdcutilBackend()._run('detect', '--terse'))]
+    return sorted(buses)
@@ -0,0 +1,220 @@
+"""
+Stand-ins for the hardware, so the app runs anywhere. Each device is swapped in by its own key under "simulate" in
+pinout.json, e.g. {"simulate": {"lcd": {"realtime": true}, "keypad": {"trace": "trace.json"}, "ddc": {"monitors": 2}}}
+"""
+import json
+import threading
+from time import monotonic, sleep
+from typing import Sequence
+
+from keypad import EventQueue
+
+import config
+from ddc import (
+    BRIGHTNESS, DISPLAY_ADDR, EDID_HEADER, EDID_LEN, GET_VCP, GET_VCP_REPLY, INPUT_SOURCE, REPLY_ADDR, SET_VCP, VOLUME,
+    DDCError, I2CBackend, checksum
+)
+from lcd import LCDBackend, ROW_OFFSETS
+from pad import BUTTON_LABELS
+
+DDRAM_ROW = 40  # each HD44780 row holds 40 characters whether or not they're visible
+# roughly what the Pi Zero takes to bit-bang a byte to the display in 4 bit mode, and the wait after clear or home
+BYTE_TIME = 100e-6
+CLEAR_TIME = 3e-3
+
+
+class FakeHD44780(LCDBackend):
+    """Stands in for the display without touching GPIO, counting every byte that would have been bit-banged and how
+    long that would have taken. With realtime it also takes that long."""
+
+    def __init__(self, realtime: bool = False):
+        self.ddram = bytearray(b' ' * DDRAM_ROW * len(ROW_OFFSETS))
+        self.cgram = [bytes(8) for _ in range(8)]
+        self.address = 0
+        self.shift = 0
+        self.commands = 0
+        self.writes = 0
+        self.busy = 0.  # seconds the real display would have spent
+        self.realtime = realtime
+
+    def reset_counters(self):
+        self.commands = 0
+        self.writes = 0
+        self.busy = 0.
+
+    def _spend(self, seconds: float):
+        self.busy += seconds
+        if self.realtime:
+            sleep(seconds)
+
+    def clear(self):
+        self.commands += 1
+        self._spend(CLEAR_TIME)
+        self.ddram[:] = b' ' * len(self.ddram)
+        self.address = 0
+        self.shift = 0
+
+    def move_to(self, col: int, row: int):
+        self.commands += 1
+        self._spend(BYTE_TIME)
+        self.address = row * DDRAM_ROW + col
+
+    def write(self, data: bytes):
+        self._spend(len(data) * BYTE_TIME)
+        for b in data:
+            self.writes += 1
+            self.ddram[self.address] = b
+            self.address = (self.address + 1) % len(self.ddram)
+
+    def create_char(self, location: int, pattern: Sequence[int]):
+        self.commands += 1
+        self.writes += 8
+        self._spend(9 * BYTE_TIME)
+        self.cgram[location & 0x7] = bytes(pattern)
+
+    def create_chars(self, chars: Sequence[tuple[int, Sequence[int]]]):
+        after = None
+        for location, pattern in sorted(chars):
+            self.commands += location != after
+            self.writes += 8
+            self._spend(((location != after) + 8) * BYTE_TIME)
+            self.cgram[location & 0x7] = bytes(pattern)
+            after = location + 1
+
+    def home(self):
+        self.commands += 1
+        self._spend(CLEAR_TIME)
+        self.address = 0
+        self.shift = 0
+
+    def shift_left(self):
+        self.commands += 1
+        self._spend(BYTE_TIME)
+        self.shift = (self.shift + 1) % DDRAM_ROW
+
+    def lines(self, cols: int = 16) -> list[bytes]:
+        """What's showing on each row, taking any display shift into account"""
+        rows = [bytes(self.ddram[row * DDRAM_ROW:(row + 1) * DDRAM_ROW]) for row in range(len(ROW_OFFSETS))]
+        return [(row + row)[self.shift:self.shift + cols] for row in rows]
+
+
+class FakeI2CMonitor:
+    """A DDC/CI display on the other end of an i2c device, for driving ddc.I2CBackend without hardware"""
+
+    def __init__(self, vcp: dict[int, int] = None, maximum: int = 100, latency: float = 0.):
+        self.vcp = {} if vcp is None else vcp
+        self.maximum = maximum
+        self.latency = latency  # on top of the spacing I2CBackend already leaves between commands
+        self.sets = 0
+        self.gets = 0
+        self._reply = b''
+
+    def write(self, data: bytes):
+        if self.latency:
+            sleep(self.latency)
+        if checksum(DISPLAY_ADDR, data[:-1]) != data[-1]:
+            raise DDCError(f'bad checksum: {data.hex()}')
+        match list(data[2:-1]):
+            case [op, code, hi, lo] if op == SET_VCP:
+                self.sets += 1
+                self.vcp[code] = hi << 8 | lo
+            case [op, code] if op == GET_VCP:
+                self.gets += 1
+                cur = self.vcp.get(code)
+                body = bytes([
+                    DISPLAY_ADDR, 0x88, GET_VCP_REPLY, int(cur is None), code, 0,
+                    self.maximum >> 8, self.maximum & 0xff, (cur or 0) >> 8, (cur or 0) & 0xff
+                ])
+                self._reply = body + bytes([checksum(REPLY_ADDR, body)])
+            case _:
+                raise DDCError(f'unsupported packet: {data.hex()}')
+
+    def read(self, n: int) -> bytes:
+        reply, self._reply = self._reply[:n], b''
+        return reply
+
+
+def fake_edid(serial: str, manufacturer: str = 'SIM', product: int = 1) -> bytes:
+    """Just enough of an EDID for ddc.edid_serial"""
+    mfg = sum(ord(c) - ord('A') + 1 << shift for c, shift in zip(manufacturer, (10, 5, 0)))
+    edid = bytearray(EDID_LEN)
+    edid[:8] = EDID_HEADER
+    edid[8:10] = mfg.to_bytes(2, 'big')
+    edid[10:12] = product.to_bytes(2, 'little')
+    edid[54:59] = bytes([0, 0, 0, 0xff, 0])
+    edid[59:72] = serial.encode('ascii')[:13].ljust(13, b'\n')
+    return bytes(edid)
+
+
+class FakeEDIDDevice:
+    def __init__(self, edid: bytes):
+        self.edid = edid
+
+    def write(self, data: bytes):
+        pass
+
+    def read(self, n: int) -> bytes:
+        return self.edid[:n]
+
+
+class FakeDDC(I2CBackend):
+    """A simulated monitor behind the real DDC/CI protocol code, with its inputs in ddcutil's capabilities format"""
+    CAPABILITIES = """   Feature: 60 (Input Source)
+      Values:
+         0f: DisplayPort-1
+         11: HDMI-1
+   Feature: 62 (Audio speaker volume)
+"""
+
+    def __init__(self, bus: int, latency: float = 0., vcp: dict[int, int] = None):
+        self.monitor = FakeI2CMonitor(vcp or {INPUT_SOURCE: 0x0f, BRIGHTNESS: 50, VOLUME: 20}, latency=latency)
+        super().__init__(self.monitor, bus, FakeEDIDDevice(fake_edid(f'SIM{bus}')))
+
+    def capabilities(self) -> str:
+        return self.CAPABILITIES
+
+
+def fake_ddcs(monitors: int = 1, latency: float = 0.) -> list[FakeDDC]:
+    return [FakeDDC(bus, latency) for bus in range(monitors)]
+
+
+def taps(labels: Sequence[str], start: float = 0., hold: float = .05, gap: float = .25) -> list[tuple[float, str, bool]]:
+    """A trace pressing each of labels in turn"""
+    trace = []
+    for i, label in enumerate(labels):
+        at = start + i * gap
+        trace += [(at, label, True), (at + hold, label, False)]
+    return trace
+
+
+class FakeKeyMatrix:
+    """Stands in for keypad.KeyMatrix, feeding its event queue from a thread of its own like Blinka's scanner does.
+    A trace is [seconds from when it's played, label, pressed] for each event, or a json file of them relative to the
+    repo."""
+
+    def __init__(self, trace: list | str = None, max_events: int = 64):
+        self.events = EventQueue(max_events)
+        self.thread: threading.Thread | None = None
+        if isinstance(trace, str):
+            with open(config.ROOT / trace) as f:
+                trace = json.load(f)
+        if trace:
+            self.play(trace)
+
+    def record(self, label: str, pressed: bool):
+        # looked up every time, pad.Keypad wraps it to timestamp events
+        self.events.keypad_eventqueue_record(BUTTON_LABELS.index(label), pressed)
+
+    def play(self, trace: list) -> threading.Thread:
+        def run():
+            started = monotonic()
+            for at, label, pressed in trace:
+                sleep(max(0., started + at - monotonic()))
+                self.record(label, pressed)
+
+        self.thread = threading.Thread(target=run, name='FakeKeyMatrix', daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def deinit(self):
+        pass
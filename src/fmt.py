@@ -0,0 +1,43 @@
+from datetime import datetime
+from functools import lru_cache
+
+from lcd import COLS
+from patterns import AM, PM
+
+DIRECTIONS = ['N', 'NNE', 'NE', 'ENE', 'E', 'ESE', 'SE', 'SSE', 'S', 'SSW', 'SW', 'WSW', 'W', 'WNW', 'NW', 'NNW']
+# compass point for every whole degree, each point covers 11.25° either side of it
+WIND_DIRS = tuple(DIRECTIONS[round(degrees / 22.5) % len(DIRECTIONS)] for degrees in range(360))
+
+
+def wind_dir(degrees: float) -> str:
+    return WIND_DIRS[round(degrees) % 360]
+
+
+@lru_cache(maxsize=24 * 60)
+def clock(hour: int, minute: int) -> str:
+    return f"{hour % 12 or 12}:{minute:02}{AM if hour < 12 else PM}"
+
+
+def time_str(dt: datetime) -> str:
+    """12 hour time with an AM/PM glyph, e.g. 6:05ᴾ"""
+    return clock(dt.hour, dt.minute)
+
+
+def spread(*parts: str, width: int = COLS) -> str | None:
+    """Non-empty parts spaced evenly across width, any odd columns going to the leftmost gaps. None if they don't
+    all fit with at least a space between each."""
+    parts = [p for p in parts if p]
+    if len(parts) < 2:
+        return f"{parts[0] if parts else '':<{width}}" if sum(map(len, parts)) <= width else None
+    gap, extra = divmod(width - sum(map(len, parts)), len(parts) - 1)
+    if gap < 1:
+        return None
+    return ''.join(f"{p}{' ' * (gap + (i < extra))}" for i, p in enumerate(parts[:-1])) + parts[-1]
+
+
+def fit(*lines: str | None, width: int = COLS) -> str:
+    """The first layout that fits, falling back to truncating the last one"""
+    for line in lines:
+        if line is not None and len(line) <= width:
+            return line
+    return (lines[-1] or '')[:width]
@@ -0,0 +1,79 @@
+import asyncio
+import logging
+from datetime import datetime
+
+from fmt import fit, spread, time_str
+from frame import MenuFrame, Menu
+from lcd import Align, Msg
+from patterns import FAHRENHEIT
+from weather_api import FORECAST, WeatherAPI
+
+
+def render_slot(slot: dict) -> Msg:
+    dt = datetime.fromtimestamp(slot['dt'])
+    conditions = slot['weather'][0]['main']
+    rain = f"{round(slot.get('pop', 0) * 100)}%"
+    wind = f"{round(slot['wind']['speed'])}mph"
+    return Msg(
+        spread(f"{dt:%a} {time_str(dt)}", f"{round(slot['main']['temp'])}{FAHRENHEIT}"),
+        fit(spread(conditions, f"{rain} {wind}"), spread(conditions, rain), conditions)
+    )
+
+
+def render_slots(forecast: dict) -> tuple[Msg, ...]:
+    return tuple(render_slot(slot) for slot in forecast['list'])
+
+
+class Forecast(MenuFrame):
+    """The 5 day forecast one 3-hour slot at a time, paged with 2 and 8, held down to keep paging.
+
+    Every slot is rendered once whenever new forecast data arrives, so paging is just an index."""
+    bindings = {**MenuFrame.bindings, '2:repeat': 'prev_page', '8:repeat': 'next_page'}
+
+    def __init__(self, menu: Menu, api: WeatherAPI):
+        self.lcd = menu.lcd
+        self.api = api
+        self.pages: tuple[Msg, ...] = ()
+        self.page = 0
+        self._loads: set[asyncio.Task] = set()  # the loop only keeps weak references to tasks
+        super().__init__(menu, Msg('Forecast', 'Loading', Align.CENTER, Align.CENTER))
+
+    def activate(self):
+        super().activate()
+        if not self.pages and (forecast := self.api.peek(FORECAST)):
+            self.load_soon(forecast)
+        if self.api.stale(FORECAST):
+            self.api.revalidate(FORECAST)
+
+    async def load(self, forecast: dict):
+        self.pages = await asyncio.to_thread(render_slots, forecast)
+        self.turn(0)
+
+    def load_soon(self, forecast: dict):
+        """load() in the background, e.g. from a callback"""
+        task = asyncio.create_task(self.load(forecast))
+        self._loads.add(task)
+        task.add_done_callback(self._loaded)
+
+    def _loaded(self, task: asyncio.Task):
+        self._loads.discard(task)
+        if not task.cancelled() and task.exception():
+            logging.warning(f'rendering the forecast failed: {task.exception()!r}')
+
+    def unload(self):
+        for task in self._loads:
+            task.cancel()
+
+    def turn(self, page: int):
+        if not self.pages:
+            return
+        self.page = max(0, min(page, len(self.pages) - 1))
+        self.msg = self.pages[self.page]
+        if self.active:
+            self.lcd.show(self.msg)
+
+    def prev_page(self):
+        self.turn(self.page - 1)
+
+    def next_page(self):
+        self.turn(self.page + 1)
@@ -1,19 +1,27 @@
+import importlib
 import uuid
 from dataclasses import dataclass, field
-from typing import Callable, Dict
+from datetime import datetime
+from typing import TYPE_CHECKING, Callable, ClassVar
 from uuid import UUID
 
 from kvm import KVM
-from lcd import Msg, LCD
+from lcd import Align, Msg, LCD
 from pad import BUTTON_LABELS
 
+if TYPE_CHECKING:
+    from weather_api import WeatherAPI
+
 
 @dataclass
 class Frame:
     msg: Msg
     key: UUID = field(default_factory=uuid.uuid4)
-    button_funs: Dict[str, Callable[[], None]] = field(default_factory=dict)
     active: bool = False
+    # gesture to the name of the method it calls, or a tuple of the name and its arguments, shared by every instance.
+    # A gesture is a button label, optionally suffixed ':long' or ':repeat', or a chord like 'A+B'. None is unmapped,
+    # gestures that are missing keep whatever the frame underneath had them do. See keymap.py
+    bindings: ClassVar[dict[str, str | tuple | None]] = {}
 
     def activate(self):
         self.active = True
@@ -21,10 +29,19 @@ class Frame:
     def deactivate(self):
         self.active = False
 
+    def tick(self, now: datetime):
+        """Called at the top of every minute while the frame is showing"""
+        pass
+
+    def unload(self):
+        """Called when the menu drops an idle frame, to let go of anything that would keep it alive"""
+        pass
+
 
 class Menu:
     kvm: KVM
     lcd: LCD
+    weather: 'WeatherAPI'
 
     def prev_menu(self):
         pass
@@ -32,41 +49,119 @@ class Menu:
     def next_menu(self):
         pass
 
-    def msg(self, msg: Msg | str) -> str:
+    def msg(self, msg: Msg | str) -> UUID:
         pass
 
     def msg_ephemeral(self, msg: Msg | str, seconds=5):
         pass
 
-    def numerical_input(self, msg: str, fun: Callable[[int], None], percent=True):
+    def unmapped(self, label: str):
         pass
 
-    def push(self, frame: Frame) -> str:
+    def numerical_input(self, msg: str, fun: Callable[[int], None], percent=True, current: int = None):
         pass
 
-    def pop(self, key: str = None):
+    def push(self, frame: Frame) -> UUID:
         pass
 
+    def apply(self, frame: Frame = None):
+        pass
+
+    def pop(self, key: UUID = None):
+        pass
+
+
+@dataclass
+class MenuEntry:
+    """One submenu in menu.json"""
+    frame: str  # module.Class, only imported once the frame is first shown
+    lines: list[str] = field(default_factory=list)
+    arrows: bool = False
+
+    def frame_class(self) -> type['MenuFrame']:
+        module, _, name = self.frame.rpartition('.')
+        return getattr(importlib.import_module(module), name)
+
+    def msg(self) -> Msg:
+        msg = Msg(*self.lines[:2]) if self.lines else Msg('')
+        return msg.add_arrows() if self.arrows else msg
+
 
 class MenuFrame(Frame):
+    bindings = {
+        **{label: None for label in BUTTON_LABELS},
+        '2': 'prev_menu',
+        '8': 'next_menu',
+        '*': 'back',
+        'A': 'set_volume',
+        'B': 'set_brightness',
+        'C': 'prev_display',
+        'D': 'next_display'
+    }
+
     def __init__(
             self,
             menu: Menu,
             msg: Msg
     ):
         super().__init__(msg=msg)
-        for b in BUTTON_LABELS:
-            match b:
-                case '2':
-                    self.button_funs[b] = menu.prev_menu
-                case '8':
-                    self.button_funs[b] = menu.next_menu
-                case '*':
-                    self.button_funs[b] = menu.pop
-                case _:  # for closure label is on left
-                    self.button_funs[b] = lambda m=f"{b} unmapped": menu.msg_ephemeral(m, .5)
-
-        self.button_funs['A'] = lambda: menu.numerical_input('SET VOLUME', menu.kvm.volume)
-        self.button_funs['B'] = lambda: menu.numerical_input("SET BRIGHTNESS", menu.kvm.brightness)
-        self.button_funs['C'] = lambda: menu.msg_ephemeral(Msg('DISPLAY:', menu.kvm.prev()))
-        self.button_funs['D'] = lambda: menu.msg_ephemeral(Msg('DISPLAY:', menu.kvm.next()))
+        self.menu = menu
+
+    @classmethod
+    def from_entry(cls, menu: Menu, entry: MenuEntry) -> 'MenuFrame':
+        return cls(menu, entry.msg())
+
+    def prev_menu(self):
+        self.menu.prev_menu()
+
+    def next_menu(self):
+        self.menu.next_menu()
+
+    def back(self):
+        self.menu.pop()
+
+    def set_volume(self):
+        kvm = self.menu.kvm
+        self.menu.numerical_input('SET VOLUME', kvm.volume, current=kvm.current_volume)
+
+    def set_brightness(self):
+        kvm = self.menu.kvm
+        self.menu.numerical_input('SET BRIGHTNESS', kvm.brightness, current=kvm.current_brightness)
+
+    def prev_display(self):
+        self.menu.msg_ephemeral(Msg('DISPLAY:', self.menu.kvm.prev()))
+
+    def next_display(self):
+        self.menu.msg_ephemeral(Msg('DISPLAY:', self.menu.kvm.next()))
+
+
+class NumberInput(Frame):
+    """Digits typed in on the keypad, handed to fun once # is pressed"""
+    bindings = {
+        **{label: ('digit', label) for label in BUTTON_LABELS if label.isdigit()},
+        '#': 'commit',
+        '*': 'back'
+    }
+
+    def __init__(self, menu: Menu, title: str, fun: Callable[[int], None], percent=True, current: int = None):
+        super().__init__(
+            msg=Msg(title) if current is None else Msg(title, f"{current}{'%' if percent else ''}", align_two=Align.RIGHT)
+        )
+        self.menu = menu
+        self.fun = fun
+        self.percent = percent
+        self.digits = ''
+
+    def digit(self, label: str):
+        self.digits += label
+        num = f"{min(int(self.digits), 100)}%" if self.percent else self.digits
+        self.msg = Msg(self.msg.line_one, f"{num:>16}")
+        self.menu.lcd.show(self.msg)
+
+    def commit(self):
+        if self.digits:
+            self.fun(int(self.digits))
+        self.menu.pop()
+
+    def back(self):
+        self.menu.pop()
@@ -0,0 +1,151 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from time import perf_counter
+from typing import Any, Sequence
+
+from metrics import Histogram
+
+LONG_PRESS = .6  # held this long a key's :long binding fires instead of its press
+REPEAT_DELAY = .5  # :repeat bindings fire again after the key's been held this long
+REPEAT_INTERVAL = .15  # and then this often for as long as it stays down
+
+
+@dataclass(frozen=True, slots=True)
+class Binding:
+    owner: dict  # the bindings table it came from, used to find the frame (or menu) to call it on
+    action: str | None  # method name, None is unmapped
+    args: tuple = ()
+    repeat: bool = False
+
+
+def parse(gesture: str) -> tuple[str, bool]:
+    """A bindings table key, '5', '5:long', '5:repeat' or '*+#', to what it's looked up by and whether it repeats"""
+    if gesture.endswith(':repeat'):
+        return gesture.removesuffix(':repeat'), True
+    if '+' in gesture:
+        return chord(*gesture.split('+')), False
+    return gesture, False
+
+
+def chord(*labels: str) -> str:
+    return '+'.join(sorted(labels))
+
+
+class Layer:
+    """Every bindings table from the bottom of the stack up to some frame, merged"""
+    __slots__ = ('actions', 'deferred', 'above')
+
+    def __init__(self, actions: dict[str, Binding]):
+        self.actions = actions
+        # keys that can't act as soon as they go down because they might turn into a long press or a chord
+        self.deferred = frozenset(
+            label for gesture in actions if gesture.endswith(':long') or '+' in gesture
+            for label in gesture.removesuffix(':long').split('+')
+        )
+        self.above: dict[type, Layer] = {}
+
+    def extend(self, table: dict[str, Any]) -> 'Layer':
+        if not table:
+            return self
+        actions = dict(self.actions)
+        for gesture, action in table.items():
+            key, repeat = parse(gesture)
+            name, *args = action if isinstance(action, tuple) else (action,)
+            actions[key] = Binding(table, name, tuple(args), repeat)
+        return Layer(actions)
+
+
+class Keymap:
+    """Resolves key events to actions through a stack of bindings tables, the menu's own at the bottom then every
+    frame on the menu's stack, the topmost binding for a gesture winning.
+
+    Bindings tables are class attributes, so merged layers are cached by frame class and switching frames only walks
+    that cache. A keypress is then a single dict lookup. Keys with a long press or chord bound act when they're let go
+    instead of when they go down, anything else acts immediately."""
+
+    def __init__(self, menu, bindings: dict[str, Any]):
+        self.menu = menu
+        self.base = self.layer = Layer({}).extend(bindings)
+        self.stack: Sequence = ()
+        self.held: dict[str, float] = {}
+        self.consumed: set[str] = set()  # held keys that already did something, so letting go of them doesn't
+        self._timers: dict[str, asyncio.TimerHandle] = {}
+        self.latency = Histogram('keypress_action_seconds', 'Key scanned to its bound action returned')
+
+    def use(self, stack: Sequence):
+        layer = self.base
+        for frame in stack:
+            cls = type(frame)
+            if (above := layer.above.get(cls)) is None:
+                above = layer.above[cls] = layer.extend(cls.bindings)
+            layer = above
+        self.stack = stack
+        self.layer = layer
+
+    def key(self, label: str, pressed: bool, stamp: float = None):
+        stamp = stamp or perf_counter()
+        if pressed:
+            self._down(label, stamp)
+        else:
+            self._up(label, stamp)
+
+    def _down(self, label: str, stamp: float):
+        other = next((other for other in self.held if chord(other, label) in self.layer.actions), None)
+        self.held[label] = stamp
+        if other:
+            self._cancel(other)
+            self.consumed.update((other, label))
+            return self._run(self.layer.actions[chord(other, label)], label, stamp)
+
+        if label in self.layer.deferred:
+            if f'{label}:long' in self.layer.actions:
+                self._timers[label] = asyncio.get_running_loop().call_later(LONG_PRESS, self._long, label)
+            return
+
+        self.consumed.add(label)
+        binding = self.layer.actions.get(label)
+        self._run(binding, label, stamp)
+        if binding and binding.repeat:
+            self._timers[label] = asyncio.get_running_loop().call_later(REPEAT_DELAY, self._repeat, label)
+
+    def _up(self, label: str, stamp: float):
+        self.held.pop(label, None)
+        self._cancel(label)
+        if label in self.consumed:
+            self.consumed.discard(label)
+            return
+        # a deferred key let go before it became anything else
+        self._run(self.layer.actions.get(label), label, stamp)
+
+    def _cancel(self, label: str):
+        if timer := self._timers.pop(label, None):
+            timer.cancel()
+
+    def _long(self, label: str):
+        self._timers.pop(label, None)
+        self.consumed.add(label)
+        self._run(self.layer.actions.get(f'{label}:long'), label, perf_counter())
+
+    def _repeat(self, label: str):
+        binding = self.layer.actions.get(label)
+        if label not in self.held or not binding or not binding.repeat:
+            return
+        self._run(binding, label, perf_counter())
+        self._timers[label] = asyncio.get_running_loop().call_later(REPEAT_INTERVAL, self._repeat, label)
+
+    def target(self, binding: Binding):
+        for frame in reversed(self.stack):
+            if type(frame).bindings is binding.owner:
+                return frame
+        return self.menu
+
+    def _run(self, binding: Binding | None, label: str, stamp: float):
+        if binding is None:
+            logging.info(f'{label} pressed')
+            return
+        if binding.action is None:
+            self.menu.unmapped(label)
+        else:
+            getattr(self.target(binding), binding.action)(*binding.args)
+        self.latency.observe(perf_counter() - stamp)
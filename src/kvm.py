@@ -1,7 +1,24 @@
-import json
-import subprocess
+import asyncio
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from signal import pause
+from time import perf_counter
+from typing import Callable
+
+import config
+from ddc import BRIGHTNESS, INPUT_SOURCE, VOLUME, DDCBackend, DDCError, discover_buses, edid_serial, open_backend
+from metrics import Counter, Histogram
+from monitor_cache import MonitorState, StateCache
+
+# background reconciliation of the cached state, kept well away from startup and user commands
+REFRESH_DELAY = 60
+REFRESH_INTERVAL = 15 * 60
+REFRESH_SPACING = 1
+
+ddc_latency = Histogram('ddc_command_seconds', 'Time to send a single VCP write')
+ddc_errors = Counter('ddc_errors_total', 'VCP writes that failed')
 
 
 @dataclass
@@ -10,59 +27,300 @@ class Display:
     label: str
 
 
-class KVM:
-    def __init__(self):
-        with open('../pinout.json') as f:
-            pinout = json.load(f)
+@dataclass
+class Scene:
+    """Settings to apply to every monitor at once, None leaves that setting alone"""
+    input: str | None = None  # label or id
+    brightness: int | None = None
+    volume: int | None = None
 
-        # When you get around to using a KVM again
-        # self.in = DigitalInputDevice(pinout['kvm']['in'])  # wire to KVM VGA ground/float
-        # self.out = DigitalOutputDevice(pinout['kvm']['out'])  # wire to KVM button
 
-        if 'displays' in pinout:
-            self.displays = [Display(**display) for display in pinout['displays']]
+def _retrieve(fut: asyncio.Future):
+    # failures are already logged by the queue, don't warn again for callers that never await
+    if not fut.cancelled():
+        fut.exception()
+
+
+class CommandQueue:
+    """Sends VCP writes one at a time on a worker thread. Setting a code that is still waiting to go out replaces
+    its value, so a burst of input switches or brightness changes only puts the last one on the bus."""
+
+    def __init__(self, ddc: DDCBackend, on_sent: Callable[[int, int], None] = lambda code, value: None):
+        self.ddc = ddc
+        self.on_sent = on_sent
+        self._pending: dict[int, tuple[int, list[asyncio.Future]]] = {}
+        self._worker: asyncio.Task | None = None
+
+    def pending(self, code: int) -> bool:
+        return code in self._pending
+
+    def set(self, code: int, value: int) -> asyncio.Future:
+        fut = asyncio.get_running_loop().create_future()
+        fut.add_done_callback(_retrieve)
+        _, waiters = self._pending.get(code, (None, []))
+        waiters.append(fut)
+        self._pending[code] = (value, waiters)
+        if not self._worker or self._worker.done():
+            self._worker = asyncio.create_task(self._drain())
+        return fut
+
+    async def _drain(self):
+        while self._pending:
+            code = next(iter(self._pending))
+            value, waiters = self._pending.pop(code)
+            started = perf_counter()
+            try:
+                await asyncio.to_thread(self.ddc.set_vcp, code, value)
+            except Exception as e:
+                logging.exception(f'setvcp 0x{code:02x} {value} failed')
+                ddc_errors.inc()
+                for w in waiters:
+                    if not w.done():
+                        w.set_exception(e)
+            else:
+                self.on_sent(code, value)
+                for w in waiters:
+                    if not w.done():
+                        w.set_result(value)
+            ddc_latency.observe(perf_counter() - started)
+
+
+class Monitor:
+    """One DDC/CI capable monitor, with its own bus, command queue and cached state"""
+
+    def __init__(self, ddc: DDCBackend, cache: StateCache, displays: list[Display] = None):
+        self.ddc = ddc
+        self.queue = CommandQueue(self.ddc, self._update)
+        self.cache = cache
+
+        self.serial, edid = self._identify()
+        self.state = self.cache.get(self.serial, edid)
+
+        if displays:
+            self.displays = displays
+        elif self.state and self.state.displays:
+            self.displays = [Display(**display) for display in self.state.displays]
         else:
-            capabilities = subprocess.run(["ddcutil", "capabilities"], stdout=subprocess.PIPE).stdout.decode('utf-8')
-            self.displays = [
-                Display(id=f"0x{j[0]}", label=j[1])
-                for j in [
-                    k.strip().split(': ')
-                    for k in capabilities
-                             .split("Feature: 60 (Input Source)\n", 1)[1]
-                             .split("\n   Feature: 62 (Audio speaker volume)", 1)[0]
-                             .split('\n')[1:]
-                ]
+            self.displays = self._probe_displays()
+
+        if not self.state:
+            self.state = MonitorState(edid, [d.__dict__ for d in self.displays])
+            self.cache.put(self.serial, self.state)
+
+        if INPUT_SOURCE not in self.state.vcp:
+            self._read(INPUT_SOURCE)
+        self.cur = self._input_index()
+
+    def _identify(self) -> tuple[str, str]:
+        try:
+            edid = self.ddc.edid()
+        except (DDCError, OSError) as e:
+            logging.warning(f"couldn't read EDID: {e!r}")
+            edid = b''
+        return edid_serial(edid) or f'bus-{getattr(self.ddc, "bus", None)}', hashlib.sha1(edid).hexdigest()
+
+    def _probe_displays(self) -> list[Display]:
+        capabilities = self.ddc.capabilities()
+        return [
+            Display(id=f"0x{j[0]}", label=j[1])
+            for j in [
+                k.strip().split(': ')
+                for k in capabilities
+                         .split("Feature: 60 (Input Source)\n", 1)[1]
+                         .split("\n   Feature: 62 (Audio speaker volume)", 1)[0]
+                         .split('\n')[1:]
             ]
+        ]
+
+    def _read(self, code: int) -> int | None:
+        try:
+            value = self.ddc.get_vcp(code)[0]
+        except (DDCError, OSError) as e:
+            logging.warning(f"couldn't read VCP 0x{code:02x}: {e!r}")
+            return None
+        self._update(code, value)
+        return value
+
+    def set_displays(self, displays: list[Display] = None):
+        """The inputs to cycle through, None for whatever was probed when this monitor was first seen"""
+        self.displays = displays or [Display(**display) for display in self.state.displays] or self._probe_displays()
+        self.cur = self._input_index()
+
+    def _input_index(self) -> int:
+        current_id = self.state.vcp.get(INPUT_SOURCE)
+        return next((idx for idx, d in enumerate(self.displays) if int(d.id, 16) == current_id), 0)
+
+    def _update(self, code: int, value: int):
+        self.state.vcp[code] = value
+        self.cache.touch()
 
-        current_id = '0' + subprocess.run(
-            ["ddcutil", "getvcp", "0x60", "--terse"],
-            stdout=subprocess.PIPE
-        ).stdout.decode("utf-8").strip().split(" ")[-1]
+    @property
+    def current_brightness(self) -> int | None:
+        return self.state.vcp.get(BRIGHTNESS)
 
-        self.cur = next((idx for idx, d in enumerate(self.displays) if d.id == current_id), 0)
+    @property
+    def current_volume(self) -> int | None:
+        return self.state.vcp.get(VOLUME)
+
+    @property
+    def current_display(self) -> Display:
+        return self.displays[self.cur]
+
+    async def refresh(self):
+        """Reconcile the cached state with the monitor every so often, skipping anything the user is changing"""
+        await asyncio.sleep(REFRESH_DELAY)
+        while True:
+            serial, edid = await asyncio.to_thread(self._identify)
+            if edid != self.state.edid:
+                logging.info(f'monitor changed from {self.serial} to {serial}')
+                self.serial = serial
+                self.state = self.cache.get(serial, edid) or MonitorState(edid, [d.__dict__ for d in self.displays])
+                self.cache.put(serial, self.state)
+
+            for code in (INPUT_SOURCE, BRIGHTNESS, VOLUME):
+                if self.queue.pending(code):
+                    continue
+                try:
+                    value = (await asyncio.to_thread(self.ddc.get_vcp, code))[0]
+                except (DDCError, OSError) as e:
+                    logging.warning(f"couldn't refresh VCP 0x{code:02x}: {e!r}")
+                else:
+                    if not self.queue.pending(code):
+                        self._update(code, value)
+                await asyncio.sleep(REFRESH_SPACING)
+            if not self.queue.pending(INPUT_SOURCE):
+                self.cur = self._input_index()
+
+            await asyncio.sleep(REFRESH_INTERVAL)
+
+    def apply(self, scene: Scene) -> asyncio.Future:
+        futures = []
+        if scene.input is not None:
+            idx = next((i for i, d in enumerate(self.displays) if scene.input in (d.label, d.id)), None)
+            if idx is None:
+                raise DDCError(f'{self.serial} has no input {scene.input}')
+            self.cur = idx
+            futures.append(self.switch(self.displays[idx]))
+        if scene.brightness is not None:
+            futures.append(self.brightness(scene.brightness))
+        if scene.volume is not None:
+            futures.append(self.volume(scene.volume))
+        return asyncio.gather(*futures)
 
     def prev(self) -> str:
         self.cur = (self.cur - 1) % len(self.displays)
-        return self.switch(self.displays[self.cur])
+        display = self.displays[self.cur]
+        self.switch(display)
+        return display.label
 
     def next(self) -> str:
         self.cur = (self.cur + 1) % len(self.displays)
-        return self.switch(self.displays[self.cur])
-
-    @staticmethod
-    def switch(display: Display) -> str:
-        subprocess.run(["ddcutil", "setvcp", "0x60", display.id])
+        display = self.displays[self.cur]
+        self.switch(display)
         return display.label
 
-    @staticmethod
-    def brightness(b: int):
-        b = str(max(min(b, 100), 0))
-        subprocess.run(["ddcutil", "setvcp", "0x10", b])
+    def switch(self, display: Display) -> asyncio.Future:
+        return self.queue.set(INPUT_SOURCE, int(display.id, 16))
+
+    def brightness(self, b: int) -> asyncio.Future:
+        return self.queue.set(BRIGHTNESS, max(min(b, 100), 0))
+
+    def volume(self, v: int) -> asyncio.Future:
+        return self.queue.set(VOLUME, max(min(v, 100), 0))
+
+
+def ddcs_from_config(cfg: config.Config) -> list[DDCBackend]:
+    if 'ddc' in cfg.simulate:
+        from fakes import fake_ddcs
+        return fake_ddcs(**cfg.simulate['ddc'])
+    buses = cfg.ddc_buses or discover_buses()
+    return [open_backend(bus) for bus in buses] or [open_backend()]
+
+
+def displays_from_config(cfg: config.Config) -> list[Display] | None:
+    return [Display(d.id, d.label) for d in cfg.displays] if cfg.displays is not None else None
+
+
+def scenes_from_config(cfg: config.Config) -> dict[str, Scene]:
+    return {name: Scene(s.input, s.brightness, s.volume) for name, s in cfg.scenes.items()}
+
+
+class KVM:
+    """Every monitor on the desk. Input cycling acts on the primary (first) monitor, brightness and volume and
+    scenes go out to all of them in parallel since each monitor has its own bus and queue."""
+
+    def __init__(self, ddcs: list[DDCBackend] = None, cache: StateCache = None):
+        cfg = config.current()
+
+        # When you get around to using a KVM again
+        # self.in = DigitalInputDevice(cfg.kvm.input)  # wire to KVM VGA ground/float
+        # self.out = DigitalOutputDevice(cfg.kvm.out)  # wire to KVM button
+
+        self.cache = cache or StateCache()
+        ddcs = ddcs or ddcs_from_config(cfg)
+        displays = displays_from_config(cfg)
+
+        # probing is mostly waiting on the bus, so do all monitors at once
+        with ThreadPoolExecutor(len(ddcs)) as pool:
+            self.monitors = list(pool.map(lambda ddc: Monitor(ddc, self.cache, displays), ddcs))
+
+        self.scenes = scenes_from_config(cfg)
+
+    def reconfigure(self, cfg: config.Config):
+        """Pick up changed displays and scenes. The buses are only opened at startup."""
+        displays = displays_from_config(cfg)
+        for monitor in self.monitors:
+            monitor.set_displays(displays)
+        self.scenes = scenes_from_config(cfg)
+
+    @property
+    def primary(self) -> Monitor:
+        return self.monitors[0]
+
+    @property
+    def current_brightness(self) -> int | None:
+        return self.primary.current_brightness
+
+    @property
+    def current_volume(self) -> int | None:
+        return self.primary.current_volume
+
+    @property
+    def current_display(self) -> Display:
+        return self.primary.current_display
+
+    def prev(self) -> str:
+        return self.primary.prev()
+
+    def next(self) -> str:
+        return self.primary.next()
+
+    def brightness(self, b: int) -> asyncio.Future:
+        return self._all(m.brightness(b) for m in self.monitors)
+
+    def volume(self, v: int) -> asyncio.Future:
+        return self._all(m.volume(v) for m in self.monitors)
 
     @staticmethod
-    def volume(v: int):
-        v = str(max(min(v, 100), 0))
-        subprocess.run(["ddcutil", "setvcp", "0x62", v])
+    def _all(futures) -> asyncio.Future:
+        # like each monitor's own future, fine to never await, the queue has already logged any failure
+        fut = asyncio.gather(*futures)
+        fut.add_done_callback(_retrieve)
+        return fut
+
+    async def apply_scene(self, scene: Scene | str) -> dict[str, str]:
+        """Returns 'ok' or the error for each monitor, by serial"""
+        if isinstance(scene, str):
+            scene = self.scenes[scene]
+
+        async def apply(monitor: Monitor):
+            await monitor.apply(scene)
+
+        results = await asyncio.gather(*(apply(m) for m in self.monitors), return_exceptions=True)
+        return {m.serial: 'ok' if r is None else repr(r) for m, r in zip(self.monitors, results)}
+
+    async def refresh(self):
+        await asyncio.gather(*(m.refresh() for m in self.monitors))
 
 
 if __name__ == "__main__":
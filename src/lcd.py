@@ -1,21 +1,31 @@
-import json
+import asyncio
+import logging
 import sys
-from collections import OrderedDict
-from dataclasses import dataclass
-from datetime import datetime
+import threading
 from enum import Enum
-from typing import Callable, Sequence
+from time import monotonic
+from typing import Callable, Iterable, Iterator, Sequence
 from typing import Optional
 
-from adafruit_character_lcd.character_lcd import Character_LCD_Mono
-from digitalio import DigitalInOut, Pin
-
-from patterns import BACKSLASH, UP_ARROW, DOWN_ARROW, AM, PM, patterns
+import config
+from metrics import Counter
+from patterns import UP_ARROW, DOWN_ARROW, GLYPH_IDS, compile_table, patterns
 from patterns import Pattern
 
+COLS = 16
+ROWS = 2
+ROW_OFFSETS = (0x00, 0x40)
+DDRAM_COLS = 40  # each row of DDRAM, of which 16 columns are visible at a time
+MAX_LINE = 256
+MARQUEE_GAP = 4  # blank columns between the end of a scrolling line and its start coming round again
+MARQUEE_STEP = .35
+MARQUEE_HOLD = 1.5  # seconds to wait with the start of every scrolling line showing
+_LCD_SETCGRAMADDR = 0x40
+_LCD_SETDDRAMADDR = 0x80
 
-def time_str(dt: datetime) -> str:
-    return f"{dt.strftime('%I:%M').lstrip('0')}{AM if dt.strftime('%p') == 'AM' else PM}"
+chars_written = Counter('lcd_chars_written_total', 'Characters written to DDRAM')
+commands_sent = Counter('lcd_commands_total', 'Cursor moves, display shifts and returns home')
+glyphs_uploaded = Counter('lcd_glyphs_uploaded_total', 'Custom characters written to CGRAM')
 
 
 class Align(Enum):
@@ -25,10 +35,18 @@ class Align(Enum):
     CENTER = 3
 
 
-@dataclass
+_TEXT = bytes(range(GLYPH_IDS, 256))
+_NOT_SLOTS = bytes(range(8, 256))
+
+
 class Msg:
-    line_one: str
-    line_two: str
+    """Two lines compiled once into the bytes the display shows, glyphs held as their pattern id until drawn. buf is
+    the first 32 bytes on the glass, lines longer than that scroll. Immutable and hashable, identical messages compare
+    equal."""
+    __slots__ = ('buf', 'lines', 'glyphs')
+    buf: bytes
+    lines: tuple[bytes, bytes]
+    glyphs: frozenset[Pattern]
 
     def __init__(
             self,
@@ -43,10 +61,10 @@ class Msg:
             else:
                 line_two = ''
 
-        if len(line_one) > 16:
-            line_one = line_one[:16]
-        if len(line_two) > 16:
-            line_two = line_two[:16]
+        if len(line_one) > MAX_LINE:
+            line_one = line_one[:MAX_LINE]
+        if len(line_two) > MAX_LINE:
+            line_two = line_two[:MAX_LINE]
 
         match align_one:
             case Align.LEFT:
@@ -64,78 +82,415 @@ class Msg:
             case Align.CENTER:
                 line_two = line_two.center(16, ' ')
 
-        self.line_one = line_one
-        self.line_two = line_two
+        lines = tuple(
+            f'{line:<16}'.translate(compile_table).encode('latin-1', errors='replace') for line in (line_one, line_two)
+        )
+        # scrolling glyphs stay in CGRAM for as long as the message is up, so the limit is for the whole of it
+        glyphs = frozenset(patterns[b] for b in b''.join(lines).translate(None, _TEXT))
+        if len(glyphs) > 8:
+            raise ValueError(f'Max 8 symbols per msg, {line_one!r} {line_two!r} has {len(glyphs)}')
+        object.__setattr__(self, 'buf', lines[0][:COLS] + lines[1][:COLS])
+        object.__setattr__(self, 'lines', lines)
+        object.__setattr__(self, 'glyphs', glyphs)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    def __eq__(self, other):
+        return isinstance(other, Msg) and self.lines == other.lines
+
+    def __hash__(self):
+        return hash(self.lines)
+
+    @property
+    def scrolls(self) -> bool:
+        return len(self.lines[0]) > COLS or len(self.lines[1]) > COLS
+
+    def _line(self, row: int) -> str:
+        return ''.join(patterns[b].char if b < GLYPH_IDS else chr(b) for b in self.lines[row]).rstrip(' ')
 
-    def add_arrows(self):
-        self.line_one = f'{f"{self.line_one:<16}"[:14]}2{UP_ARROW}'
-        self.line_two = f'{f"{self.line_two:<16}"[:14]}8{DOWN_ARROW}'
-        return self
+    @property
+    def line_one(self) -> str:
+        return self._line(0)
+
+    @property
+    def line_two(self) -> str:
+        return self._line(1)
+
+    def add_arrows(self) -> 'Msg':
+        return Msg(f'{f"{self.line_one:<16}"[:14]}2{UP_ARROW}', f'{f"{self.line_two:<16}"[:14]}8{DOWN_ARROW}')
 
     def __repr__(self):
         return f'{self.line_one}\n{self.line_two}'
 
 
-class PatternCache:
-    def __init__(self, create_char: Callable[[int, Sequence[int]], None]):
-        self._create_char = create_char
-        self._cache = OrderedDict[int, int]({i: i for i in range(8)})
-        assert all(i in [p.i for p in patterns] for i in self._cache)
-        for p in patterns:
-            if p.i in self._cache:
-                self._create_char(p.i, p.seq)
+class GlyphSlots:
+    """Assigns patterns to the 8 CGRAM slots a whole frame at a time.
+
+    Glyphs the next frame needs keep their slots, anything missing goes in an empty slot, then one whose glyph isn't
+    on the glass any more, then the least recently drawn. Only the latter can briefly show the wrong glyph before the
+    new frame overwrites it."""
+
+    def __init__(self):
+        self.slots: list[Pattern | None] = [None] * 8
+        self._where: dict[int, int] = {}  # pattern id to slot
+        self._drawn = [0] * 8  # the last frame each slot was used in
+        self._frame = 0
+        # translating a compiled Msg through this swaps pattern ids for the slots they're loaded in
+        self.table = bytearray(range(256))
+        self.hits = 0
+        self.misses = 0
+        self.uploads = 0
 
-    def __getitem__(self, p: Pattern) -> str:
-        if p.i in self._cache:
-            self._cache.move_to_end(p.i)
-            i = self._cache[p.i]
-        else:
-            i = self._cache.popitem(last=False)[1]
-            self._cache[p.i] = i
-            self._create_char(i, p.seq)
-        return int.to_bytes(i).decode()
+    def allocate(self, glyphs: Iterable[Pattern], shadow: bytes) -> list[tuple[int, Pattern]]:
+        """Slots for every glyph of the next frame, returning the CGRAM writes that needs"""
+        self._frame += 1
+        missing = []
+        for p in glyphs:
+            if (slot := self._where.get(p.i)) is None:
+                missing.append(p)
+            else:
+                self._drawn[slot] = self._frame
+        self.hits += len(glyphs) - len(missing)
+        self.misses += len(missing)
+        if not missing:
+            return []
 
+        visible = set(shadow.translate(None, _NOT_SLOTS))
+        free = sorted(
+            (s for s in range(8) if self._drawn[s] != self._frame),
+            key=lambda s: (self.slots[s] is not None, s in visible, self._drawn[s])
+        )
+        writes = list(zip(free, missing))
+        for slot, p in writes:
+            if old := self.slots[slot]:
+                del self._where[old.i]
+            self.slots[slot] = p
+            self._where[p.i] = slot
+            self.table[p.i] = slot
+            self._drawn[slot] = self._frame
+        self.uploads += len(writes)
+        return writes
 
-class LCD(Character_LCD_Mono):
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'uploads': self.uploads,
+            'slots': [p.name if p else None for p in self.slots]
+        }
 
-    def __init__(self):
-        with open('../pinout.json') as f:
-            pins = json.load(f)['display_bcm_pins']
+
+class Marquee:
+    """How far a message with lines longer than the display has scrolled"""
+
+    def __init__(self, lines: Sequence[bytes]):
+        # lines that fit stay put, the rest loop round with a gap between their end and start
+        self.loops = [line + b' ' * MARQUEE_GAP if len(line) > COLS else line for line in lines]
+        # the display can move both rows around their 40 columns of DDRAM with a single command and no writes at all,
+        # as long as every line either scrolls within those 40 columns or is blank
+        self.hardware = all(COLS < len(loop) <= DDRAM_COLS or not loop.strip() for loop in self.loops)
+        if self.hardware:
+            self.loops = [loop.ljust(DDRAM_COLS) for loop in self.loops]
+        self.offset = 0
+
+    def rows(self) -> bytes:
+        """Every row as it's laid out in DDRAM for hardware scrolling"""
+        return b''.join(self.loops)
+
+    def window(self) -> bytes:
+        """What should be showing for software scrolling"""
+        return b''.join(self._visible(loop) for loop in self.loops)
+
+    def _visible(self, loop: bytes) -> bytes:
+        if len(loop) == COLS:
+            return loop
+        start = self.offset % len(loop)
+        return loop[start:start + COLS] + loop[:max(0, start + COLS - len(loop))]
+
+    def advance(self) -> float:
+        """Move along a column, returning how long to leave it there"""
+        self.offset += 1
+        lapped = all(self.offset % len(loop) == 0 for loop in self.loops if len(loop) > COLS)
+        return MARQUEE_HOLD if lapped else MARQUEE_STEP
+
+
+class LCDBackend:
+    """The handful of HD44780 operations the renderer needs"""
+
+    def clear(self):
+        pass
+
+    def move_to(self, col: int, row: int):
+        pass
+
+    def write(self, data: bytes):
+        pass
+
+    def create_char(self, location: int, pattern: Sequence[int]):
+        pass
+
+    def create_chars(self, chars: Sequence[tuple[int, Sequence[int]]]):
+        for location, pattern in chars:
+            self.create_char(location, pattern)
+
+    def home(self):
+        """Undo any display shift"""
+        pass
+
+    def shift_left(self):
+        """Move what's showing one column left, scrolling the window right along DDRAM"""
+        pass
+
+    def close(self):
+        """Let go of the pins, e.g. before a new backend takes over from this one"""
+        pass
+
+
+class GpioBackend(LCDBackend):
+    def __init__(self, pins: config.DisplayPins):
+        # imported here so the rest of this module works on machines without GPIO
+        from adafruit_character_lcd.character_lcd import Character_LCD_Mono
+        from digitalio import DigitalInOut, Pin
 
         # vss = GND (https://pinout.xyz/pinout/ground)
         # vdd = 5V (https://pinout.xyz/pinout/5v_power)
         # v0 = middle of trimpot
-        super().__init__(
-            DigitalInOut(Pin(pins['RS'])),
-            DigitalInOut(Pin(pins['EN'])),
-            DigitalInOut(Pin(pins['D4'])),
-            DigitalInOut(Pin(pins['D5'])),
-            DigitalInOut(Pin(pins['D6'])),
-            DigitalInOut(Pin(pins['D7'])),
-            16,
-            2
-        )
+        self._pins = []
+        try:
+            for pin in (pins.RS, pins.EN, pins.D4, pins.D5, pins.D6, pins.D7):
+                self._pins.append(DigitalInOut(Pin(pin)))
+            self._lcd = Character_LCD_Mono(*self._pins, COLS, ROWS)
+        except Exception:
+            # don't leave the pins that were claimed unusable for anything else
+            self.close()
+            raise
+
+    def clear(self):
+        self._lcd.clear()
+
+    def move_to(self, col: int, row: int):
+        # cursor_position() clamps to the visible width, go straight to the address instead
+        self._lcd._write8(_LCD_SETDDRAMADDR | (col + ROW_OFFSETS[row]))
+
+    def write(self, data: bytes):
+        for b in data:
+            self._lcd._write8(b, char_mode=True)
+
+    def close(self):
+        for pin in self._pins:
+            pin.deinit()
+
+    def create_char(self, location: int, pattern: Sequence[int]):
+        self._lcd.create_char(location, pattern)
+
+    def home(self):
+        self._lcd.home()
+
+    def shift_left(self):
+        self._lcd.move_left()
+
+    def create_chars(self, chars: Sequence[tuple[int, Sequence[int]]]):
+        # the CGRAM address auto-increments, so neighbouring slots only need the one set address command
+        after = None
+        for location, pattern in sorted(chars):
+            if location != after:
+                self._lcd._write8(_LCD_SETCGRAMADDR | (location << 3))
+            for row in pattern:
+                self._lcd._write8(row, char_mode=True)
+            after = location + 1
+
+
+def diff_runs(old: bytes, new: bytes, start: int, end: int) -> Iterator[tuple[int, int]]:
+    """Yields [start, end) runs of cells that differ. A single unchanged cell between two runs costs the same to
+    rewrite as a cursor move, so those get merged."""
+    run = None
+    for i in range(start, end):
+        if old[i] != new[i]:
+            if run and i - run[1] <= 1:
+                run[1] = i + 1
+            else:
+                if run:
+                    yield run[0], run[1]
+                run = [i, i + 1]
+    if run:
+        yield run[0], run[1]
+
+
+def backend_from_config(cfg: config.Config) -> LCDBackend:
+    if 'lcd' in cfg.simulate:
+        from fakes import FakeHD44780
+        return FakeHD44780(**cfg.simulate['lcd'])
+    return GpioBackend(cfg.display_bcm_pins)
+
 
-        self.pattern_cache = PatternCache(self.create_char)
-        self.clear()
+class LCD:
+
+    def __init__(self, backend: LCDBackend = None, max_fps: float = 20):
+        # what the backend was built from, None if it was handed in
+        self.config = None if backend else config.current()
+        self.backend = backend or backend_from_config(self.config)
+        self.cgram = [bytes(8)] * 8  # so the glass can be mirrored elsewhere
+        self.on_draw: Callable[[], None] = lambda: None  # called from the event loop after each render
+        self.glyphs = GlyphSlots()
+        self.backend.clear()
+        # what's currently on the glass, so updates only send the cells that changed
+        self.shadow = bytearray(b' ' * COLS * ROWS)
+        # and the whole of DDRAM with how far it's shifted, for hardware scrolling
+        self.ddram = bytearray(b' ' * DDRAM_COLS * ROWS)
+        self.shifted = 0
+        self.marquee: Marquee | None = None
+        self.next_step = 0.
+
+        # latest-wins mailbox drained by run(), so bursts of updates collapse into one physical write
+        self._pending: Optional[Msg] = None
+        self._dirty = asyncio.Event()
+        self._lock = threading.RLock()
+        self.min_interval = 1 / max_fps
+
+    def show(self, m: Msg):
+        """Queue m for the render task without blocking, replacing anything not yet drawn"""
+        self._pending = m
+        self._dirty.set()
+
+    def flush(self):
+        """Draw whatever is queued right now, for when the render task isn't running (e.g. shutdown)"""
+        m, self._pending = self._pending, None
+        if m:
+            self.msg(m)
+
+    async def run(self):
+        """Draws whatever's shown and scrolls the marquee, the only task that touches the display"""
+        while True:
+            if self.marquee:
+                try:
+                    await asyncio.wait_for(self._dirty.wait(), max(0., self.next_step - monotonic()))
+                except asyncio.TimeoutError:
+                    await asyncio.to_thread(self.step)
+                    self.on_draw()
+                    continue
+            else:
+                await self._dirty.wait()
+            self._dirty.clear()
+            m, self._pending = self._pending, None
+            if m is None:
+                continue
+            started = monotonic()
+            # bit-banging GPIO is slow, keep it off the event loop
+            await asyncio.to_thread(self.msg, m)
+            self.on_draw()
+            await asyncio.sleep(self.min_interval - (monotonic() - started))
+
+    def reinit(self, cfg: config.Config):
+        """Set the display up again from cfg, e.g. after its pins were changed, going back to the old pins if that fails.
+        Either way it starts out blank, so redraw whatever was on it afterwards."""
+        with self._lock:
+            previous = self.config
+            if previous:
+                # the old pins have to be let go before they can be claimed again
+                self.backend.close()
+            try:
+                backend = backend_from_config(cfg)
+            except Exception:
+                if previous:
+                    try:
+                        # back to the display as it was rather than none at all
+                        self._use(backend_from_config(previous), previous)
+                    except Exception:
+                        # the old backend is closed, draw to nothing until a config that works comes along
+                        logging.exception('restoring the previous display failed')
+                        self.backend, self.config = LCDBackend(), None
+                raise
+            if not previous:
+                self.backend.close()
+            self._use(backend, cfg)
+
+    def _use(self, backend: LCDBackend, cfg: config.Config):
+        self.backend, self.config = backend, cfg
+        self.glyphs = GlyphSlots()
+        self.cgram = [bytes(8)] * 8
+        self.invalidate()
+
+    def invalidate(self):
+        with self._lock:
+            self.backend.clear()
+            self.shadow[:] = b' ' * COLS * ROWS
+            self.ddram[:] = b' ' * DDRAM_COLS * ROWS
+            self.shifted = 0
+            self.marquee = None
 
     def msg(self, m: Msg):
-        self.clear()
+        """Draw m immediately, blocking until the display has been written. Prefer show() from the event loop."""
+        with self._lock:
+            if writes := self.glyphs.allocate(m.glyphs, self.shadow):
+                # all of the frame's glyphs go up together ahead of the cells that show them
+                for slot, p in writes:
+                    self.cgram[slot] = bytes(p.seq)
+                self.backend.create_chars([(slot, p.seq) for slot, p in writes])
+                glyphs_uploaded.inc(len(writes))
+            table = self.glyphs.table
+            if not m.scrolls:
+                self.marquee = None
+                return self.draw(m.buf.translate(table))
+
+            self.marquee = Marquee([line.translate(table) for line in m.lines])
+            self.next_step = monotonic() + MARQUEE_HOLD
+            if self.marquee.hardware:
+                self._home()
+                self._load(self.marquee.rows())
+            else:
+                self.draw(self.marquee.window())
+
+    def step(self):
+        """Scroll the marquee along a column"""
+        with self._lock:
+            if not self.marquee:
+                return
+            self.next_step = monotonic() + self.marquee.advance()
+            if self.marquee.hardware:
+                self.backend.shift_left()
+                commands_sent.inc()
+                self.shifted = (self.shifted + 1) % DDRAM_COLS
+                self.shadow[:] = self._window()
+            else:
+                self.draw(self.marquee.window())
+
+    def _home(self):
+        if self.shifted:
+            self.backend.home()
+            commands_sent.inc()
+            self.shifted = 0
+            self.shadow[:] = self._window()
 
-        s = (
-            f'{m.line_one}\n{m.line_two}'
-            .replace('\\', str(BACKSLASH))
-            .replace('\t', ' ')
+    def _window(self) -> bytes:
+        return b''.join(
+            (row + row)[self.shifted:self.shifted + COLS]
+            for row in (self.ddram[:DDRAM_COLS], self.ddram[DDRAM_COLS:])
         )
-        count = 0
-        for p in patterns:
-            if p.char in s:
-                count += 1
-                if count > 8:
-                    raise Exception('Max 8 symbols per msg')
-                s.replace(p.char, self.pattern_cache[p])
-
-        self.message = s
+
+    def _load(self, rows: bytes):
+        """Write all of DDRAM, rows being 40 columns each"""
+        for row in range(ROWS):
+            for start, end in diff_runs(self.ddram, rows, row * DDRAM_COLS, (row + 1) * DDRAM_COLS):
+                self.backend.move_to(start - row * DDRAM_COLS, row)
+                self.backend.write(rows[start:end])
+                commands_sent.inc()
+                chars_written.inc(end - start)
+        self.ddram[:] = rows
+        self.shadow[:] = self._window()
+
+    def draw(self, frame: bytes):
+        """Write the 32 cells of frame to the unshifted display"""
+        with self._lock:
+            self._home()
+            for row in range(ROWS):
+                for start, end in diff_runs(self.shadow, frame, row * COLS, (row + 1) * COLS):
+                    self.backend.move_to(start - row * COLS, row)
+                    self.backend.write(frame[start:end])
+                    commands_sent.inc()
+                    chars_written.inc(end - start)
+                self.ddram[row * DDRAM_COLS:row * DDRAM_COLS + COLS] = frame[row * COLS:(row + 1) * COLS]
+            self.shadow[:] = frame
 
 
 if __name__ == "__main__":
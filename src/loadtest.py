@@ -0,0 +1,95 @@
+"""
+Floods a running instance with messages and reports how many per second it accepted.
+
+    python loadtest.py http://pi.local:1602 --mode ws --messages 2000 --batch 16
+
+Every connection counts against the same per-client rate limit, so expect 429s past the configured rate; run it
+from several machines (or raise messages.RATE) to measure raw ingestion.
+"""
+import argparse
+import asyncio
+import json
+from collections import Counter
+from time import perf_counter
+
+import httpx
+import websockets
+
+
+def payloads(n: int, unique: bool) -> list[dict]:
+    return [{'lines': [f'load {i if unique else 0}', 'test'], 'duration': .5, 'ttl': 5} for i in range(n)]
+
+
+def tally(results: Counter, result: dict | list):
+    for r in result if isinstance(result, list) else [result]:
+        results[r.get('status', 200)] += 1
+
+
+async def run_post(url: str, messages: list[dict], concurrency: int, results: Counter):
+    async with httpx.AsyncClient(base_url=url, limits=httpx.Limits(max_connections=concurrency)) as client:
+        async def send(message: dict):
+            res = await client.post('/', json=message)
+            results[res.status_code] += 1
+
+        for i in range(0, len(messages), concurrency):
+            await asyncio.gather(*(send(m) for m in messages[i:i + concurrency]))
+
+
+async def run_batch(url: str, messages: list[dict], batch: int, concurrency: int, results: Counter):
+    batches = [messages[i:i + batch] for i in range(0, len(messages), batch)]
+    async with httpx.AsyncClient(base_url=url, limits=httpx.Limits(max_connections=concurrency)) as client:
+        async def send(chunk: list[dict]):
+            res = await client.post('/batch', json=chunk)
+            if res.is_success:
+                tally(results, res.json())
+            else:
+                results[res.status_code] += len(chunk)
+
+        for i in range(0, len(batches), concurrency):
+            await asyncio.gather(*(send(b) for b in batches[i:i + concurrency]))
+
+
+async def run_ws(url: str, messages: list[dict], batch: int, concurrency: int, results: Counter):
+    ws_url = url.replace('http', 'ws', 1).rstrip('/') + '/ws'
+
+    async def connection(chunks: list[list[dict]]):
+        async with websockets.connect(ws_url) as ws:
+            for chunk in chunks:
+                await ws.send(json.dumps(chunk if batch > 1 else chunk[0]))
+                tally(results, json.loads(await ws.recv()))
+
+    chunks = [messages[i:i + batch] for i in range(0, len(messages), batch)]
+    await asyncio.gather(*(connection(chunks[i::concurrency]) for i in range(concurrency)))
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('url', nargs='?', default='http://localhost:1602')
+    parser.add_argument('--mode', choices=['post', 'batch', 'ws'], default='batch')
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--batch', type=int, default=16)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--repeat', action='store_true', help='send the same message every time to exercise dedupe')
+    args = parser.parse_args()
+
+    messages = payloads(args.messages, not args.repeat)
+    results = Counter()
+    started = perf_counter()
+    match args.mode:
+        case 'post':
+            await run_post(args.url, messages, args.concurrency, results)
+        case 'batch':
+            await run_batch(args.url, messages, args.batch, args.concurrency, results)
+        case 'ws':
+            await run_ws(args.url, messages, args.batch, args.concurrency, results)
+    elapsed = perf_counter() - started
+
+    print(f'{args.mode}: {len(messages)} messages in {elapsed:.2f}s, {len(messages) / elapsed:.0f} msg/s sent')
+    print(f'accepted {results[200]} ({results[200] / elapsed:.0f} msg/s)')
+    for code, n in sorted(results.items()):
+        if code != 200:
+            print(f'  {code}: {n}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
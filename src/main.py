@@ -1,15 +1,10 @@
 import asyncio
 import logging
-from collections import deque
 from contextlib import asynccontextmanager
-from time import monotonic
 
-from fastapi import FastAPI
-
-import server
-from lcd import Msg, Align
-from main_menu import MainMenu
-from pad import Keypad
+import config
+from lcd import LCD, Msg, Align
+from startup import Startup
 
 logging.basicConfig(level=logging.INFO)
 logging.info("""
@@ -21,60 +16,113 @@ logging.info("""
                                                                                                                                 
 """)
 
-keypad = Keypad()
-menu = MainMenu(keypad)
+SPLASH = Msg('Monitor', 'Control', align_two=Align.RIGHT)
+
+# get something on the glass before anything slow happens, everything else is imported and built after
+startup = Startup()
+with startup.phase('splash'):
+    lcd = LCD()
+    lcd.msg(SPLASH)
+
+with startup.phase('imports'):
+    from fastapi import FastAPI
+
+    import server
+    from frame import MenuEntry
+    from kvm import KVM
+    from main_menu import MainMenu
+    from pad import Keypad
+    from supervisor import Supervisor, Watchdog
+    from telemetrics import Collector, exporters_from_config
+
+supervisor = Supervisor()
 
-MAX_INTERVAL = 30
-RETRY_HISTORY = 3
 
+def preload():
+    """Imports the first screen's frame class, and with it whatever it needs"""
+    MenuEntry(config.current().menu.submenus[0].frame).frame_class()
 
-# That is, stop after the 3rd failure in a 30 second moving window
 
-def supervise(func, name=None, retry_history=RETRY_HISTORY, max_interval=MAX_INTERVAL):
-    """Simple wrapper function that automatically tries to name tasks"""
-    if name is None:
-        if hasattr(func, '__name__'):  # raw func
-            name = func.__name__
-        elif hasattr(func, 'func'):  # partial
-            name = func.func.__name__
-    return asyncio.create_task(supervisor(func, retry_history, max_interval), name=name)
+def weather_api():
+    # importing httpx and setting up its TLS context both take a while on a Pi Zero
+    from weather_api import WeatherAPI
+    return WeatherAPI.from_config(config.current().weather)
 
 
-async def supervisor(func, retry_history=RETRY_HISTORY, max_interval=MAX_INTERVAL):
-    """Takes a noargs function that creates a coroutine, and repeatedly tries
-        to run it. It stops is if it thinks the coroutine is failing too often or
-        too fast.
-    """
-    start_times = deque([float('-inf')], maxlen=retry_history)
-    while True:
-        start_times.append(monotonic())
+def watch_config(keypad: Keypad, menu: MainMenu, collector: Collector) -> config.ConfigWatcher:
+    """Applies config changes live, each to just the part of the app it affects"""
+    watcher = config.ConfigWatcher()
+
+    def reinit_lcd(cfg: config.Config):
         try:
-            return await func()
-        except asyncio.CancelledError:
-            logging.exception(f'{func.__name__} cancelled.')
-        except Exception as e:
-            if min(start_times) > monotonic() - max_interval:
-                raise e
-            else:
-                logging.exception(
-                    f'{func.__name__} failed, will retry. Failed because:\n{str(e)}',
-                    stack_info=True
-                )
+            lcd.reinit(cfg)
+        finally:
+            # whichever display it ended up with starts out blank
+            menu.apply()
+
+    watcher.subscribe(('display_bcm_pins', 'simulate.lcd'), reinit_lcd)
+    watcher.subscribe(('keypad_bcm_pins', 'simulate.keypad'), keypad.reinit)
+    watcher.subscribe(('displays', 'scenes'), menu.kvm.reconfigure)
+    watcher.subscribe('menu', lambda cfg: menu.reload_menu(cfg.menu))
+    watcher.subscribe('weather', menu.reconfigure_weather)
+    watcher.subscribe('glyph_packs', menu.load_glyph_packs)
+    watcher.subscribe('telemetry', lambda cfg: collector.replace_exporters(exporters_from_config(cfg)))
+    restart = ('ddc_buses', 'kvm', 'simulate.ddc')
+    watcher.subscribe(restart, lambda cfg: logging.warning(f'restart to apply changes to {", ".join(restart)}'))
+    return watcher
+
+
+async def boot(app: FastAPI):
+    """Everything the menu needs, with the slow parts in threads alongside each other"""
+    try:
+        with startup.phase('keypad'):
+            keypad = app.extra['keypad'] = Keypad()
+        # probing monitors is mostly waiting on ddcutil
+        kvm, weather, _ = await asyncio.gather(
+            startup.thread('kvm', KVM),
+            startup.thread('weather', weather_api),
+            startup.thread('preload', preload)
+        )
+        with startup.phase('menu'):
+            menu = MainMenu(keypad, lcd=lcd, kvm=kvm, weather=weather)
+    except Exception:
+        logging.exception('startup failed')
+        lcd.msg(Msg('Startup', 'Failed', Align.CENTER, Align.CENTER))
+        raise
+    menu.msg_ephemeral(SPLASH)
+    collector = app.extra['telemetry'] = Collector(
+        {'queue': lambda: len(menu.messages)},
+        exporters_from_config(config.current())
+    )
+    watcher = app.extra['config'] = watch_config(keypad, menu, collector)
+    supervisor.start('Keypad', keypad.run)
+    supervisor.start('Menu', menu.run)
+    supervisor.start('Telemetry', collector.run)
+    supervisor.start('Config', watcher.run)
+    app.extra['menu'] = menu
+    startup.done()
 
 
 @asynccontextmanager
-async def lifespan(_: FastAPI):
-    menu.msg_ephemeral(Msg('Monitor', 'Control', align_two=Align.RIGHT))
-    tasks = [
-        supervise(keypad.run, name='Keypad'),
-        supervise(menu.run, name='Menu')
-    ]
+async def lifespan(app: FastAPI):
+    # serve straight away, anything that needs the menu isn't available until boot() is done
+    supervisor.start('Watchdog', Watchdog().run)
+    booting = asyncio.create_task(boot(app), name='Boot')
 
     yield
-    menu.msg(Msg('Shutting', 'Down', Align.CENTER, Align.CENTER))
-    for task in tasks:
-        task.cancel()
+    booting.cancel()
+    msg = Msg('Shutting', 'Down', Align.CENTER, Align.CENTER)
+    if menu := app.extra.get('menu'):
+        menu.msg(msg)
+        lcd.flush()
+    else:
+        lcd.msg(msg)
+    await supervisor.stop()
+    if menu:
+        await menu.aclose()
+    if collector := app.extra.get('telemetry'):
+        await collector.aclose()
 
 
-app = FastAPI(lifespan=lifespan, menu=menu)
+app = FastAPI(lifespan=lifespan, startup=startup, supervisor=supervisor)
 app.include_router(server.router)
@@ -1,112 +1,318 @@
 import asyncio
 import logging
-from typing import Callable, List
+from datetime import datetime
+from enum import Enum
+from functools import cached_property
+from heapq import heapify, heappop, heappush
+from itertools import count
+from time import monotonic, time
+from typing import TYPE_CHECKING, Callable, List
+from uuid import UUID
 
-from frame import Frame, Menu, MenuFrame
+import config
+from broadcast import Broadcast
+from frame import Frame, Menu, MenuEntry, MenuFrame, NumberInput
 from kvm import KVM
+from keymap import Keymap
 from lcd import LCD, Msg
-from pad import Keypad, SyntheticButton
-from weather import Weather
+from messages import MessageQueue
+from metrics import Gauge
+from pad import Keypad
+from patterns import load_pack
+
+if TYPE_CHECKING:
+    from weather_api import WeatherAPI
+
+MAX_TOASTS = 16
+
+
+def entries_from_config(menu: config.MenuConfig) -> list[MenuEntry]:
+    return [MenuEntry(entry.frame, list(entry.lines), entry.arrows) for entry in menu.submenus]
+
+
+class ToastPolicy(Enum):
+    DROP_OLDEST = 0  # expire the oldest toast early to make room
+    DROP_NEWEST = 1  # ignore new toasts until there's room
+    MERGE = 2  # like DROP_OLDEST, but a toast identical to one still up just extends it
+
+
+class Toasts:
+    """Expires every ephemeral frame from a single task sleeping on a heap of deadlines. Rescheduled or expired
+    entries are left in the heap and skipped when they surface."""
+
+    def __init__(self, menu: Menu, max_pending: int = MAX_TOASTS, policy: ToastPolicy = ToastPolicy.MERGE):
+        self.menu = menu
+        self.max_pending = max_pending
+        self.policy = policy
+        self._heap: list[tuple[float, int, UUID]] = []
+        self._deadlines: dict[UUID, float] = {}  # live toasts, oldest first
+        self._keys: dict[Msg, UUID] = {}
+        self._msgs: dict[UUID, Msg] = {}
+        self._seq = count()  # tiebreaker so the heap never compares keys
+        self._wake = asyncio.Event()
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def show(self, msg: Msg, seconds: float) -> UUID | None:
+        if self.policy is ToastPolicy.MERGE and (key := self._keys.get(msg)):
+            self._schedule(key, seconds)
+            return key
+
+        if len(self._deadlines) >= self.max_pending:
+            if self.policy is ToastPolicy.DROP_NEWEST:
+                logging.info(f'dropping toast {msg!r}')
+                return None
+            self.expire(next(iter(self._deadlines)))
+
+        key = self.menu.msg(msg)
+        self._keys[msg] = key
+        self._msgs[key] = msg
+        self._schedule(key, seconds)
+        return key
+
+    def _schedule(self, key: UUID, seconds: float):
+        deadline = monotonic() + seconds
+        self._deadlines[key] = deadline
+        heappush(self._heap, (deadline, next(self._seq), key))
+        if self._heap[0][2] == key:
+            self._wake.set()
+        if len(self._heap) > 2 * len(self._deadlines) + MAX_TOASTS:
+            self._heap = [entry for entry in self._heap if self._deadlines.get(entry[2]) == entry[0]]
+            heapify(self._heap)
+
+    def expire(self, key: UUID):
+        if self.forget(key):
+            self.menu.pop(key)
+
+    def forget(self, key: UUID) -> bool:
+        """Stop tracking key, e.g. its frame was dismissed with * before it expired, so nothing merges into it"""
+        if self._deadlines.pop(key, None) is None:
+            return False
+        msg = self._msgs.pop(key)
+        if self._keys.get(msg) == key:
+            del self._keys[msg]
+        return True
+
+    async def run(self):
+        while True:
+            self._wake.clear()
+            now = monotonic()
+            while self._heap and self._heap[0][0] <= now:
+                deadline, _, key = heappop(self._heap)
+                if self._deadlines.get(key) == deadline:
+                    self.expire(key)
+            try:
+                await asyncio.wait_for(self._wake.wait(), self._heap[0][0] - now if self._heap else None)
+            except asyncio.TimeoutError:
+                pass
 
 
 class MainMenu(Menu):
-    def __init__(self, keypad: Keypad):
-        self.buttons: dict[str, SyntheticButton] = keypad.buttons
-        self.kvm = KVM()
-        self.lcd = LCD()
+    # under every frame's bindings, see keymap.py
+    bindings = {
+        '*:long': 'home',
+        'A+B': 'mute'
+    }
+
+    def __init__(
+            self,
+            keypad: Keypad,
+            max_toasts: int = MAX_TOASTS,
+            toast_policy: ToastPolicy = ToastPolicy.MERGE,
+            lcd: LCD = None,
+            kvm: KVM = None,
+            weather: 'WeatherAPI' = None
+    ):
+        cfg = config.current()
+        self.glyph_packs: set[str] = set()
+        self.load_glyph_packs(cfg)
+        self.entries = entries_from_config(cfg.menu)
+        self.idle_unload = cfg.menu.idle_unload
+
+        self.keymap = Keymap(self, self.bindings)
+        keypad.on_key = self.keymap.key
+        self.kvm = kvm or KVM()
+        self.lcd = lcd or LCD()
+        if weather:
+            self.weather = weather
+        self.toasts = Toasts(self, max_toasts, toast_policy)
+        self.messages = MessageQueue()
+        self.mirror = Broadcast()
+        Gauge('message_queue_depth', 'Messages waiting to be shown', fun=lambda: len(self.messages))
+        Gauge('menu_frames', 'Frames live on the menu stack, toasts included', fun=lambda: len(self.frames))
+        self.lcd.on_draw = self.publish_screen
 
+        # submenus are only built when first shown, and dropped again after idle_unload seconds out of sight
         self.cur = 0
-        self.submenus: List[MenuFrame] = [
-            Weather(self),
-            MenuFrame(self, Msg('Main Menu').add_arrows())
-        ]
-        self.stack: List[Frame] = [self.submenus[0]]
+        self.submenus: dict[int, MenuFrame] = {}
+        self.last_shown: dict[int, float] = {}
+        self.stack: List[Frame] = [self.submenu(0)]
+        # frames still live on the stack by key, anything on the stack but not in here was popped from the middle
+        self.frames: dict[UUID, Frame] = {self.stack[0].key: self.stack[0]}
         self.stack[0].activate()
         self.apply()
 
+    @cached_property
+    def weather(self) -> 'WeatherAPI':
+        # httpx is a slow import on a Pi Zero, leave it until a frame wants the weather
+        from weather_api import WeatherAPI
+        return WeatherAPI.from_config(config.current().weather)
+
+    async def aclose(self):
+        if 'weather' in vars(self):
+            await self.weather.aclose()
+
+    def load_glyph_packs(self, cfg: config.Config):
+        """Any packs not loaded yet. Glyphs can't be taken away again, a pack only drops out on restart."""
+        for path in cfg.glyph_packs:
+            if path not in self.glyph_packs:
+                load_pack(cfg.path(path))
+                self.glyph_packs.add(path)
+
+    def reload_menu(self, menu: config.MenuConfig):
+        """Rebuild every submenu from menu, e.g. after menu.json changed, staying on the same one if it's still there"""
+        self.entries = entries_from_config(menu)
+        self.idle_unload = menu.idle_unload
+        self.close_all()
+        for frame in self.submenus.values():
+            frame.unload()
+        self.submenus.clear()
+        self.last_shown.clear()
+        self.show_submenu(self.cur)
+
+    def reconfigure_weather(self, cfg: config.Config):
+        if 'weather' not in vars(self):
+            return
+        self.weather.reconfigure(cfg.weather)
+        # whether the weather is set up properly is only looked at when a frame is built
+        self.reload_menu(cfg.menu)
+
+    def submenu(self, i: int) -> MenuFrame:
+        if not (frame := self.submenus.get(i)):
+            entry = self.entries[i]
+            frame = self.submenus[i] = entry.frame_class().from_entry(self, entry)
+        self.last_shown[i] = monotonic()
+        return frame
+
     async def run(self):
-        await asyncio.gather(*[f() for f in [*self.stack, *self.submenus] if callable(f)])
+        await asyncio.gather(self.lcd.run(), self.kvm.refresh(), self.toasts.run(), self.show_messages(), self.clock())
+
+    async def clock(self):
+        """Ticks whatever's showing at the top of every minute and drops submenus that have sat idle"""
+        while True:
+            await asyncio.sleep(60 - time() % 60)
+            self.stack[-1].tick(datetime.now())
+            self.unload_idle()
+
+    def unload_idle(self):
+        now = monotonic()
+        for i, frame in list(self.submenus.items()):
+            if i != self.cur and now - self.last_shown[i] > self.idle_unload:
+                logging.info(f'unloading idle {self.entries[i].frame}')
+                frame.unload()
+                del self.submenus[i]
+
+    def publish_screen(self):
+        cells = bytes(self.lcd.shadow)
+        self.mirror.publish({
+            'cells': list(cells),
+            'glyphs': {c: list(self.lcd.cgram[c & 0x7]) for c in set(cells) if c < 0x10},
+            'frames': len(self.frames),
+            'toasts': len(self.toasts),
+            'queued': len(self.messages)
+        })
+
+    async def show_messages(self):
+        """Cycle through queued API messages one at a time, each for its own duration"""
+        while True:
+            message = await self.messages.get()
+            self.msg_ephemeral(message.msg, message.duration)
+            await asyncio.sleep(message.duration)
+
+    def show_submenu(self, i: int):
+        old = self.stack[0]
+        old.deactivate()
+        self.cur = i % len(self.entries)
+        frame = self.submenu(self.cur)
+        # the current submenu is the bottom of the stack, what everything else pops back to
+        del self.frames[old.key]
+        self.stack[0] = self.frames[frame.key] = frame
+        self.apply(frame)
+        frame.activate()
+
+    def close_all(self):
+        """Everything on top of the current submenu"""
+        for frame in self.stack[1:]:
+            if self.frames.pop(frame.key, None):
+                self.toasts.forget(frame.key)
+                frame.deactivate()
+        del self.stack[1:]
+
+    def home(self):
+        """Straight back to the first submenu from however deep the stack is"""
+        self.close_all()
+        self.show_submenu(0)
+
+    def mute(self):
+        self.kvm.volume(0)
+        self.msg_ephemeral(Msg('VOLUME:', 'muted'))
 
     def prev_menu(self):
-        self.submenus[self.cur].deactivate()
-        self.cur = (self.cur - 1) % len(self.submenus)
-        self.apply(self.submenus[self.cur])
-        self.submenus[self.cur].activate()
+        self.show_submenu(self.cur - 1)
 
     def next_menu(self):
-        self.submenus[self.cur].deactivate()
-        self.cur = (self.cur + 1) % len(self.submenus)
-        self.apply(self.submenus[self.cur])
-        self.submenus[self.cur].activate()
+        self.show_submenu(self.cur + 1)
 
-    def msg(self, msg: Msg | str) -> str:
+    def msg(self, msg: Msg | str) -> UUID:
         if isinstance(msg, str):
             msg = Msg(msg)
 
-        self.lcd.msg(msg)
+        self.lcd.show(msg)
         return self.push(Frame(msg))
 
     def msg_ephemeral(self, msg: Msg | str, seconds=5):
-        async def inner(m, s):
-            key = self.msg(m)
-            await asyncio.sleep(s)
-            self.pop(key)
-
-        asyncio.create_task(inner(msg, seconds))
-
-    def numerical_input(self, msg: str, fun: Callable[[int], None], percent=True):
-        queue = []
-
-        # since self.msg at the bottom of this function adds to the stack, len() will refer to that element
-        cur_stack = len(self.stack)
-
-        for button in self.buttons.values():
-            if button.label.isdigit():
-                def inner(cur_label=button.label):  # default arg is required to wrap the button label in a closure
-                    queue.append(cur_label)
-                    stack_msg = self.stack[cur_stack].msg
-                    num = ''.join(queue)
-                    if percent:
-                        num = f"{min(int(num), 100)}%"
-                    stack_msg.line_two = f"""{num:>16}"""
-                    self.lcd.msg(stack_msg)
-
-                button.press = inner
-            if button.label == '#':
-                def commit():
-                    fun(int(''.join(queue)))
-                    self.pop()
+        self.toasts.show(Msg(msg) if isinstance(msg, str) else msg, seconds)
 
-                button.press = commit
+    def unmapped(self, label: str):
+        self.msg_ephemeral(f'{label} unmapped', .5)
 
-        self.msg(msg)
+    def numerical_input(self, msg: str, fun: Callable[[int], None], percent=True, current: int = None):
+        frame = NumberInput(self, msg, fun, percent, current)
+        self.push(frame)
+        self.apply(frame)
 
     def apply(self, frame: Frame = None):
         if not frame:
             frame = self.stack[-1]
 
-        for label, fun in frame.button_funs.items():
-            self.buttons[label].press = fun
-        self.lcd.msg(frame.msg)
+        self.keymap.use(self.stack)
+        self.lcd.show(frame.msg)
 
-    def push(self, frame: Frame) -> str:
+    def push(self, frame: Frame) -> UUID:
         self.stack[-1].deactivate()
         frame.activate()
         self.stack.append(frame)
+        self.frames[frame.key] = frame
+        self.keymap.use(self.stack)
         return frame.key
 
-    def pop(self, key: str = None):
+    def pop(self, key: UUID = None):
         logging.info(f'pop {key=}')
-        if len(self.stack) > 1:
-            if key:
-                idx = next((i for (i, s) in enumerate(self.stack) if key == s.key), None)
-                if idx:
-                    self.stack[idx].deactivate()
-                    del self.stack[idx]
-                    if idx != len(self.stack):
-                        return  # don't need to refresh UI if pulling from middle of stack
-            else:
-                self.stack[-1].deactivate()
+        top = self.stack[-1]
+        frame = self.frames.get(key or top.key)
+        if frame and frame is not self.stack[0]:
+            del self.frames[frame.key]
+            self.toasts.forget(frame.key)
+            frame.deactivate()
+            if frame is not top:
+                # don't need to refresh UI if pulling from middle of stack, it's dropped once it surfaces
+                if len(self.stack) > 2 * len(self.frames) + MAX_TOASTS:
+                    self.stack = [f for f in self.stack if f.key in self.frames]
+                    self.keymap.use(self.stack)
+                return
+            self.stack.pop()
+            while self.stack[-1].key not in self.frames:
                 self.stack.pop()
 
         self.stack[-1].activate()
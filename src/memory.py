@@ -0,0 +1,56 @@
+import gc
+import tracemalloc
+
+TOP = 10
+
+
+class MemoryProfile:
+    """Allocation tracing that's only on between start() and stop(), since it slows down every allocation while it is.
+    Reports compare against the snapshot taken at start(). Everything here is slow, call it from a thread."""
+
+    def __init__(self, frames: int = 1):
+        self.frames = frames
+        self.baseline: tracemalloc.Snapshot | None = None
+
+    @property
+    def tracing(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+        self.baseline = tracemalloc.take_snapshot()
+
+    def stop(self) -> dict:
+        report = self.report()
+        tracemalloc.stop()
+        self.baseline = None
+        return report
+
+    def report(self, limit: int = TOP) -> dict:
+        # debug only and slow to import
+        import objgraph
+
+        gc.collect()
+        report = {'tracing': self.tracing, 'object_counts': dict(objgraph.most_common_types(limit=20))}
+        if not self.tracing:
+            return report
+
+        snapshot = tracemalloc.take_snapshot()
+        if self.baseline:
+            stats = snapshot.compare_to(self.baseline, 'lineno')
+        else:
+            # PYTHONTRACEMALLOC=1 traces from startup without a baseline
+            stats = snapshot.statistics('lineno')
+        report['top_memory_allocations'] = [
+            {
+                'file': stat.traceback[0].filename,
+                'line': stat.traceback[0].lineno,
+                'size': stat.size,
+                'count': stat.count,
+                **({'size_diff': stat.size_diff, 'count_diff': stat.count_diff} if self.baseline else {})
+            }
+            for stat in stats[:limit]
+        ]
+        report['total_tracked_memory'] = tracemalloc.get_traced_memory()
+        return report
@@ -0,0 +1,165 @@
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from heapq import heapify, heappop, heappush
+from itertools import count
+from time import monotonic
+
+from lcd import Msg
+
+MAX_DEPTH = 64
+MAX_SOURCES = 256
+DEFAULT_DURATION = 5
+DEFAULT_TTL = 5 * 60
+# per source, sustained messages/second and how many can arrive at once
+RATE = 5.
+BURST = 20
+
+
+class QueueFull(Exception):
+    pass
+
+
+class RateLimited(Exception):
+    pass
+
+
+@dataclass
+class Message:
+    msg: Msg
+    source: str
+    priority: int = 0
+    duration: float = DEFAULT_DURATION
+    expires: float = field(default_factory=lambda: monotonic() + DEFAULT_TTL)
+    seq: int = 0
+    repeats: int = 0  # identical messages folded into this one
+
+    def describe(self, now: float) -> dict:
+        return {
+            'lines': [self.msg.line_one, self.msg.line_two],
+            'source': self.source,
+            'priority': self.priority,
+            'duration': self.duration,
+            'ttl': round(self.expires - now, 1),
+            'repeats': self.repeats
+        }
+
+
+class TokenBucket:
+    def __init__(self, rate: float = RATE, burst: int = BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self) -> bool:
+        self.refill(monotonic())
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class MessageQueue:
+    """Messages waiting for their turn on the LCD, highest priority first then oldest first.
+
+    Identical messages that are still waiting are folded together, each source is rate limited and messages that
+    wait longer than their ttl are dropped. When full, a new message only gets in by evicting a lower priority one.
+    Reprioritized or consumed entries are left in the heap and skipped when they surface."""
+
+    def __init__(self, max_depth: int = MAX_DEPTH, rate: float = RATE, burst: int = BURST):
+        self.max_depth = max_depth
+        self.rate = rate
+        self.burst = burst
+        self._heap: list[tuple[int, int, Message]] = []
+        self._pending: dict[Msg, Message] = {}
+        self._buckets: dict[str, TokenBucket] = {}
+        self._seq = count()
+        self._ready = asyncio.Event()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _push(self, message: Message):
+        heappush(self._heap, (-message.priority, message.seq, message))
+        if len(self._heap) > 2 * len(self._pending) + self.max_depth:
+            self._heap = [entry for entry in self._heap if self._live(entry[2], entry[0])]
+            heapify(self._heap)
+        self._ready.set()
+
+    def _allow(self, source: str) -> bool:
+        if source not in self._buckets and len(self._buckets) >= MAX_SOURCES:
+            now = monotonic()
+            for s, bucket in list(self._buckets.items()):
+                bucket.refill(now)
+                if bucket.tokens >= bucket.burst:
+                    del self._buckets[s]
+        bucket = self._buckets.setdefault(source, TokenBucket(self.rate, self.burst))
+        return bucket.take()
+
+    def put(
+            self,
+            msg: Msg,
+            source: str,
+            priority: int = 0,
+            duration: float = DEFAULT_DURATION,
+            ttl: float = DEFAULT_TTL
+    ) -> Message:
+        expires = monotonic() + ttl
+        if existing := self._pending.get(msg):
+            existing.repeats += 1
+            existing.expires = max(existing.expires, expires)
+            existing.duration = max(existing.duration, duration)
+            if priority > existing.priority:
+                existing.priority = priority
+                self._push(existing)
+            return existing
+
+        if not self._allow(source):
+            raise RateLimited(source)
+
+        self._expire()
+        if len(self._pending) >= self.max_depth:
+            victim = min(self._pending.values(), key=lambda m: (m.priority, -m.seq))
+            if victim.priority >= priority:
+                raise QueueFull()
+            logging.info(f'evicting {victim.msg!r} for higher priority message')
+            del self._pending[victim.msg]
+
+        message = Message(msg, source, priority, duration, expires, next(self._seq))
+        self._pending[msg] = message
+        self._push(message)
+        return message
+
+    def _live(self, message: Message, priority: int) -> bool:
+        return self._pending.get(message.msg) is message and message.priority == -priority
+
+    def _expire(self):
+        now = monotonic()
+        for msg, message in list(self._pending.items()):
+            if message.expires < now:
+                logging.info(f'{msg!r} expired before it was shown')
+                del self._pending[msg]
+
+    async def get(self) -> Message:
+        while True:
+            self._expire()
+            while self._heap:
+                priority, _, message = heappop(self._heap)
+                if self._live(message, priority):
+                    del self._pending[message.msg]
+                    return message
+            self._ready.clear()
+            await self._ready.wait()
+
+    def snapshot(self) -> list[dict]:
+        now = monotonic()
+        return [
+            m.describe(now)
+            for m in sorted(self._pending.values(), key=lambda m: (-m.priority, m.seq))
+            if m.expires >= now
+        ]
@@ -0,0 +1,119 @@
+from bisect import bisect_left
+from typing import Callable, Sequence
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5)
+
+# every metric by name and labels, the last one created with the same pair replacing any before it
+registry: dict[tuple[str, str], 'Metric'] = {}
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, description: str = '', labels: dict[str, str] = None):
+        self.name = name
+        self.description = description
+        self.labels = ','.join(f'{k}="{v}"' for k, v in (labels or {}).items())
+        registry[(name, self.labels)] = self
+
+    def samples(self) -> list[tuple[str, str, float]]:
+        """Each line of the Prometheus text format as its name suffix, labels and value"""
+        return []
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, description: str = '', labels: dict[str, str] = None):
+        super().__init__(name, description, labels)
+        self.value = 0
+
+    def inc(self, n: float = 1):
+        self.value += n
+
+    def samples(self) -> list[tuple[str, str, float]]:
+        return [('', self.labels, self.value)]
+
+
+class Gauge(Metric):
+    """Either set, or read from fun whenever it's scraped"""
+    kind = 'gauge'
+
+    def __init__(self, name: str, description: str = '', labels: dict[str, str] = None, fun: Callable[[], float] = None):
+        super().__init__(name, description, labels)
+        self.value = 0.
+        self.fun = fun
+
+    def set(self, value: float):
+        self.value = value
+
+    def samples(self) -> list[tuple[str, str, float]]:
+        return [('', self.labels, self.fun() if self.fun else self.value)]
+
+
+class Histogram(Metric):
+    """Fixed-bucket histogram, cheap enough to leave on all the time"""
+    kind = 'histogram'
+
+    def __init__(
+            self,
+            name: str,
+            description: str = '',
+            buckets: Sequence[float] = LATENCY_BUCKETS,
+            labels: dict[str, str] = None
+    ):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self.count = 0
+        self.sum = 0.
+        self.max = 0.
+        self.last = 0.
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.last = value
+        if value > self.max:
+            self.max = value
+
+    def snapshot(self) -> dict:
+        return {
+            'count': self.count,
+            'mean': self.sum / self.count if self.count else 0.,
+            'max': self.max,
+            'last': self.last,
+            'buckets': dict(zip([*map(str, self.buckets), '+Inf'], self.counts))
+        }
+
+    def samples(self) -> list[tuple[str, str, float]]:
+        prefix = f'{self.labels},' if self.labels else ''
+        samples = []
+        total = 0
+        for le, n in zip([*map(str, self.buckets), '+Inf'], self.counts):
+            total += n  # Prometheus buckets are cumulative
+            samples.append(('_bucket', f'{prefix}le="{le}"', total))
+        samples.append(('_sum', self.labels, self.sum))
+        samples.append(('_count', self.labels, self.count))
+        return samples
+
+
+def exposition() -> str:
+    """Everything in the registry in the Prometheus text format"""
+    lines = []
+    described = set()
+    for metric in sorted(registry.values(), key=lambda m: m.name):
+        if metric.name not in described:
+            described.add(metric.name)
+            lines.append(f'# HELP {metric.name} {metric.description}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+        for suffix, labels, value in metric.samples():
+            lines.append(f'{metric.name}{suffix}{{{labels}}} {value}' if labels else f'{metric.name}{suffix} {value}')
+    lines.append('')
+    return '\n'.join(lines)
+
+
+# observed by supervisor.Watchdog
+loop_lag = Histogram('event_loop_lag_seconds', 'How late a sleep on the event loop woke up')
+
@@ -0,0 +1,70 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+from dataclasses import dataclass, field, asdict
+
+import config
+
+CACHE_PATH = str(config.ROOT / 'monitor_cache.json')
+SAVE_DELAY = 10  # batch up writes to spare the SD card
+
+
+@dataclass
+class MonitorState:
+    edid: str  # sha1 of the raw EDID, a different one means a different (or reconfigured) monitor
+    displays: list[dict] = field(default_factory=list)
+    vcp: dict[int, int] = field(default_factory=dict)
+
+
+class StateCache:
+    """Monitor capabilities and last known VCP values keyed by EDID serial, so startup doesn't need the bus"""
+
+    def __init__(self, path: str = CACHE_PATH):
+        self.path = path
+        self._states: dict[str, MonitorState] = {}
+        self._save_handle: asyncio.TimerHandle | None = None
+        self._lock = threading.Lock()  # monitors are probed from worker threads at startup
+        try:
+            with open(path) as f:
+                for serial, state in json.load(f).items():
+                    state['vcp'] = {int(code): value for code, value in state['vcp'].items()}
+                    self._states[serial] = MonitorState(**state)
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError, TypeError) as e:
+            logging.warning(f'ignoring unreadable {path}: {e!r}')
+
+    def get(self, serial: str, edid: str) -> MonitorState | None:
+        state = self._states.get(serial)
+        if state and state.edid != edid:
+            logging.info(f'EDID for {serial} changed, dropping cached state')
+            del self._states[serial]
+            return None
+        return state
+
+    def put(self, serial: str, state: MonitorState):
+        with self._lock:
+            self._states[serial] = state
+        self.touch()
+
+    def touch(self):
+        """Note that a state changed, saving a little later from the event loop if there is one"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return self.save()
+        if not self._save_handle:
+            self._save_handle = loop.call_later(SAVE_DELAY, self.save)
+
+    def save(self):
+        self._save_handle = None
+        tmp = f'{self.path}.tmp'
+        with self._lock:
+            try:
+                with open(tmp, 'w') as f:
+                    json.dump({serial: asdict(state) for serial, state in self._states.items()}, f, indent=2)
+                os.replace(tmp, self.path)
+            except OSError as e:
+                logging.warning(f"couldn't save {self.path}: {e!r}")
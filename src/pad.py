@@ -1,12 +1,15 @@
 import asyncio
-import json
 import logging
+from collections import deque
 from dataclasses import dataclass
+from time import perf_counter
 from typing import Callable
 
-from digitalio import Pin
 from keypad import KeyMatrix, Event
 
+import config
+from metrics import Histogram
+
 BUTTON_LABELS = [
     '1', '2', '3', 'A',
     '4', '5', '6', 'B',
@@ -14,6 +17,11 @@ BUTTON_LABELS = [
     '*', '0', '#', 'D'
 ]
 
+# fallback poll interval, doubling from min to max while no keys are pressed
+POLL_MIN = .02
+POLL_MAX = 1.
+POLL_MAX_UNHOOKED = .1  # when scans can't wake us up, keep polling fast enough to feel responsive
+
 
 @dataclass
 class SyntheticButton:
@@ -26,26 +34,117 @@ class SyntheticButton:
         self.press = lambda: logging.info(f"{label} pressed")
 
 
+def matrix_from_config(cfg: config.Config) -> KeyMatrix:
+    if 'keypad' in cfg.simulate:
+        from fakes import FakeKeyMatrix
+        return FakeKeyMatrix(**cfg.simulate['keypad'])
+    # only importable on a Pi
+    from digitalio import Pin
+    pins = cfg.keypad_bcm_pins
+    return KeyMatrix([Pin(p) for p in pins.rows], [Pin(p) for p in pins.cols])
+
+
 class Keypad:
     buttons: dict[str, SyntheticButton]
 
-    def __init__(self):
-        with open('../pinout.json') as f:
-            pins = json.load(f)['keypad_bcm_pins']
-
-        self.matrix = KeyMatrix(
-            [Pin(p) for p in pins['rows']],
-            [Pin(p) for p in pins['cols']]
-        )
+    def __init__(self, matrix: KeyMatrix = None):
+        # what the matrix was built from, None if it was handed in
+        self.config = None if matrix else config.current()
+        self.matrix = matrix or matrix_from_config(self.config)
         self._buttons = [SyntheticButton(label) for label in BUTTON_LABELS]
         self.buttons = {button.label: button for button in self._buttons}
+        # every press and release, with when it was scanned if that's known
+        self.on_key: Callable[[str, bool, float | None], None] = self._press
+
+        self.latency = Histogram('keypress_latency_seconds', 'Key scanned to on_key returned')
+        self._stamps = deque(maxlen=len(BUTTON_LABELS) * 4)
+        self._wake = asyncio.Event()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self.hooked = self._hook()
+
+    def _press(self, label: str, pressed: bool, stamp: float = None):
+        if pressed:
+            self.buttons[label].press()
+
+    def _hook(self) -> bool:
+        """Blinka's KeyMatrix scans on its own thread and just appends to a queue. Wrap that append so every
+        recorded event timestamps itself and wakes run() right away instead of waiting for the next poll."""
+        events = self.matrix.events
+        record = getattr(events, 'keypad_eventqueue_record', None)
+        if record is None:
+            return False
+
+        def notify(key_number: int, current: bool):
+            # stamped first, run() can take the event off the queue as soon as it's recorded
+            self._stamps.append(perf_counter())
+            record(key_number, current)
+            if events.overflowed:
+                # the event was dropped, so the stamps no longer line up with what's queued. Start both over rather
+                # than give every later key someone else's scan time.
+                logging.warning('keypad event queue overflowed, dropping queued keys')
+                events.clear()
+                self._stamps.clear()
+                return
+            if self._loop:
+                self._loop.call_soon_threadsafe(self._wake.set)
+
+        events.keypad_eventqueue_record = notify
+        return True
+
+    def reinit(self, cfg: config.Config):
+        """Set the key matrix up again from cfg, e.g. after its pins were changed, going back to the old pins if that
+        fails"""
+        previous = self.config
+        if previous:
+            # the old pins have to be let go before they can be claimed again
+            self.matrix.deinit()
+        try:
+            matrix = matrix_from_config(cfg)
+        except Exception:
+            if previous:
+                try:
+                    self._use(matrix_from_config(previous))
+                except Exception:
+                    # the old matrix is deinitialised, go without keys until a config that works comes along
+                    logging.exception('restoring the previous keypad failed')
+                    from fakes import FakeKeyMatrix
+                    self.config = None
+                    self._use(FakeKeyMatrix())
+            raise
+        if not previous:
+            self.matrix.deinit()
+        self.config = cfg
+        self._use(matrix)
+
+    def _use(self, matrix: KeyMatrix):
+        self.matrix = matrix
+        self._stamps.clear()
+        for button in self._buttons:
+            button.value = False
+        self.hooked = self._hook()
+        self._wake.set()
 
     async def run(self):
+        self._loop = asyncio.get_running_loop()
+        interval = POLL_MIN
         event = Event()
         while True:
-            if self.matrix.events.get_into(event) and event.pressed:
-                self._buttons[event.key_number].press()
-            await asyncio.sleep(.05)
+            self._wake.clear()
+            handled = 0
+            while self.matrix.events.get_into(event):
+                handled += 1
+                stamp = self._stamps.popleft() if self._stamps else None
+                button = self._buttons[event.key_number]
+                button.value = event.pressed
+                self.on_key(button.label, event.pressed, stamp)
+                if stamp:
+                    self.latency.observe(perf_counter() - stamp)
+
+            interval = POLL_MIN if handled else min(interval * 2, POLL_MAX if self.hooked else POLL_MAX_UNHOOKED)
+            try:
+                await asyncio.wait_for(self._wake.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
 
 
 if __name__ == "__main__":
@@ -1,16 +1,30 @@
-import gc
-from typing import Sequence
+import json
+import logging
 
+PRIVATE_USE = 0xE000
+# compiled messages hold glyphs as their id in the control character range, which text never uses
+GLYPH_IDS = 0x20
+
+patterns: list['Pattern'] = []  # every glyph defined so far, the index is its id
+by_name: dict[str, 'Pattern'] = {}
+# str.translate table from text to what a compiled Msg holds, control characters (tabs etc.) have no place on the LCD
+compile_table: dict[int, int | str] = {c: ' ' for c in range(GLYPH_IDS)}
 
-class Pattern(object):
-    _i = 0
 
-    def __init__(self, *seq: int):
+class Pattern(object):
+    def __init__(self, *seq: int, name: str = None):
         assert (len(seq) == 8)
-        self.i = Pattern._i
-        Pattern._i += 1
-        self.char = int.to_bytes(self.i).decode()
+        self.i = len(patterns)
+        if self.i >= GLYPH_IDS:
+            raise ValueError(f'no room for more than {GLYPH_IDS} glyphs')
+        # private use area, so a glyph can never be mistaken for text (RIGHT_ARROW used to be '\t')
+        self.char = chr(PRIVATE_USE + self.i)
         self.seq = seq
+        self.name = name
+        patterns.append(self)
+        compile_table[ord(self.char)] = self.i
+        if name:
+            by_name[name] = self
 
     def __repr__(self):
         return self.char
@@ -22,15 +36,38 @@ class Pattern(object):
         return self.char
 
 
-BACKSLASH = Pattern(0, 0, 16, 8, 4, 2, 1, 0)
-UP_ARROW = Pattern(0, 0, 4, 14, 31, 0, 0, 0)
-DOWN_ARROW = Pattern(0, 0, 31, 14, 4, 0, 0, 0)
-AM = Pattern(4, 10, 14, 10, 0, 10, 21, 17)
-PM = Pattern(12, 10, 12, 8, 0, 10, 21, 17)
-FAHRENHEIT = Pattern(24, 24, 7, 4, 7, 4, 4, 0)
-MOON = Pattern(0, 14, 17, 17, 17, 14, 0, 0)
-SUN = Pattern(0, 14, 31, 31, 31, 14, 0, 0)
-LEFT_ARROW = Pattern(0, 2, 6, 14, 6, 2, 0, 0)
-RIGHT_ARROW = Pattern(0, 8, 12, 14, 12, 8, 0, 0)
+def parse_row(row: int | str) -> int:
+    """A row of 5 pixels, either as bits or drawn like '.#.#.'"""
+    return int(row.replace('.', '0').replace('#', '1'), 2) if isinstance(row, str) else row
+
+
+def load_pack(path: str) -> list[Pattern]:
+    """Defines the glyphs in a json file of {"name": [8 rows]}, skipping names that are already taken"""
+    with open(path) as f:
+        pack = json.load(f)
+    loaded = []
+    for name, rows in pack.items():
+        seq = tuple(parse_row(r) for r in rows)
+        if len(seq) != 8 or not all(0 <= r < 32 for r in seq):
+            raise ValueError(f'{path}: {name} needs 8 rows of 5 pixels')
+        if name in by_name:
+            logging.warning(f'{path}: there is already a glyph called {name}')
+            continue
+        loaded.append(Pattern(*seq, name=name))
+    logging.info(f'loaded {path}: {", ".join(f"{p.name}=U+{ord(p.char):04X}" for p in loaded)}')
+    return loaded
+
+
+BACKSLASH = Pattern(0, 0, 16, 8, 4, 2, 1, 0, name='backslash')
+UP_ARROW = Pattern(0, 0, 4, 14, 31, 0, 0, 0, name='up_arrow')
+DOWN_ARROW = Pattern(0, 0, 31, 14, 4, 0, 0, 0, name='down_arrow')
+AM = Pattern(4, 10, 14, 10, 0, 10, 21, 17, name='am')
+PM = Pattern(12, 10, 12, 8, 0, 10, 21, 17, name='pm')
+FAHRENHEIT = Pattern(24, 24, 7, 4, 7, 4, 4, 0, name='fahrenheit')
+MOON = Pattern(0, 14, 17, 17, 17, 14, 0, 0, name='moon')
+SUN = Pattern(0, 14, 31, 31, 31, 14, 0, 0, name='sun')
+LEFT_ARROW = Pattern(0, 2, 6, 14, 6, 2, 0, 0, name='left_arrow')
+RIGHT_ARROW = Pattern(0, 8, 12, 14, 12, 8, 0, 0, name='right_arrow')
 
-patterns: Sequence[Pattern] = [o for o in gc.get_objects() if isinstance(o, Pattern)]
+# the HD44780 ROM has ¥ where ASCII has \
+compile_table[ord('\\')] = BACKSLASH.i
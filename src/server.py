@@ -1,24 +1,39 @@
-import gc
+import asyncio
 import json
 import logging
-import tracemalloc
+import math
+from pathlib import Path
+from time import monotonic
 
-import objgraph
-from fastapi import HTTPException, Request, FastAPI, status, APIRouter
-from fastapi.responses import FileResponse, HTMLResponse, Response
+from fastapi import HTTPException, Request, FastAPI, status, APIRouter, WebSocket, WebSocketDisconnect
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.requests import HTTPConnection
 
-from lcd import Msg
+from lcd import MAX_LINE, Msg
 from main_menu import MainMenu
-
-# Start tracemalloc at app startup
-tracemalloc.start()
+from memory import MemoryProfile
+from messages import DEFAULT_DURATION, DEFAULT_TTL, QueueFull, RateLimited
+from metrics import Counter, exposition
+from pad import Keypad
+from patterns import patterns
+from startup import Startup
+from supervisor import Supervisor
+from telemetrics import RESOLUTIONS, Collector
 
 router = APIRouter()
 
-with open('res/index.html', 'r') as f:
+MAX_BATCH = 64
+RES = Path(__file__).parent / 'res'
+
+memory = MemoryProfile()
+messages_accepted = Counter('messages_total', 'Messages received over HTTP', {'result': 'accepted'})
+messages_limited = Counter('messages_total', 'Messages received over HTTP', {'result': 'rate_limited'})
+messages_full = Counter('messages_total', 'Messages received over HTTP', {'result': 'queue_full'})
+
+with open(RES / 'index.html', 'r') as f:
     index = HTMLResponse(content=f.read())
 
-favicon = FileResponse(path='res/favicon.ico', media_type="text/x-favicon")
+favicon = FileResponse(path=RES / 'favicon.ico', media_type="text/x-favicon")
 
 
 @router.get("/favicon.ico")
@@ -31,59 +46,241 @@ async def get_index():
     return index
 
 
+def parse_message(body) -> dict:
+    """Either the web UI's ["line one", "line two"], or {"lines": [...], "priority": 0, "duration": 5, "ttl": 300}"""
+    if isinstance(body, list):
+        body = {'lines': body}
+    if not isinstance(body, dict) or not isinstance(body.get('lines'), list):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Ya gotta give me something")
+
+    lines = [*body['lines'], '', ''][:2]
+    if not all(isinstance(line, str) for line in lines):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Lines must be strings")
+    line_one, line_two = lines
+    if not line_one and not line_two:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Both lines empty")
+    if len(line_one) > MAX_LINE or len(line_two) > MAX_LINE:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Max {MAX_LINE} char per line")
+
+    try:
+        priority = int(body.get('priority', 0))
+        duration = float(body.get('duration', DEFAULT_DURATION))
+        ttl = float(body.get('ttl', DEFAULT_TTL))
+    except (TypeError, ValueError, OverflowError) as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=repr(e))
+    # json takes NaN and Infinity, which would get past the clamping below and stall the queue sleeping on them
+    if not math.isfinite(duration) or not math.isfinite(ttl):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Duration and ttl must be finite")
+    try:
+        msg = Msg(line_one, line_two)
+    except ValueError as e:
+        # e.g. more glyphs than the display can hold at once
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    return {
+        'msg': msg,
+        'priority': priority,
+        'duration': min(max(duration, .5), 60),
+        'ttl': min(max(ttl, 1), 60 * 60)
+    }
+
+
+def enqueue(conn: HTTPConnection, message: dict) -> dict:
+    menu: MainMenu | None = conn.app.extra.get('menu')
+    if not menu:
+        logging.info(message['msg'])
+        return {}
+
+    try:
+        queued = menu.messages.put(source=conn.client.host if conn.client else '', **message)
+    except RateLimited:
+        messages_limited.inc()
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="Slow down")
+    except QueueFull:
+        messages_full.inc()
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Queue full")
+    messages_accepted.inc()
+    return queued.describe(monotonic())
+
+
+def try_enqueue(conn: HTTPConnection, body) -> dict:
+    """enqueue() for one message out of many, reporting failures in the result instead of failing them all"""
+    try:
+        return enqueue(conn, parse_message(body))
+    except HTTPException as e:
+        return {'error': e.detail, 'status': e.status_code}
+
+
+def parse_batch(body) -> list:
+    if not isinstance(body, list):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Expected a list of messages")
+    if len(body) > MAX_BATCH:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=f"Max {MAX_BATCH} per batch")
+    return body
+
+
 @router.post("/")
 async def post(request: Request):
-    body = await request.body()
+    try:
+        body = json.loads(await request.body())
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Body must be JSON")
+    return enqueue(request, parse_message(body))
+
 
+@router.post("/batch")
+async def post_batch(request: Request):
+    """A list of messages in either format POST / takes, with a result for each"""
     try:
-        line_one, line_two = json.loads(body.decode('utf-8'))
-        if not line_one and not line_two:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Both lines empty")
-        elif len(line_one) > 16 or len(line_two) > 16:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Max 16 char per line")
-        else:
-            message = Msg(line_one, line_two)
-            menu: MainMenu | None = request.app.extra.get('menu')
-            if menu:
-                menu.msg_ephemeral(message)
-            else:
-                logging.info(message)
-
-            return Response(status_code=status.HTTP_200_OK)
-    except Exception as e:
-        if 'not enough values to unpack' in repr(e):
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Ya gotta give me something")
-        else:
-            logging.error(repr(e))
-            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        body = json.loads(await request.body())
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Body must be JSON")
+    return [try_enqueue(request, message) for message in parse_batch(body)]
 
 
-@router.get("/debug/memory")
-async def memory_debug():
-    # Get current memory snapshot
-    snapshot = tracemalloc.take_snapshot()
-    top_stats = snapshot.statistics('lineno')
+@router.websocket("/ws")
+async def messages_ws(websocket: WebSocket):
+    """Each frame is a message or a list of messages, answered with the same results /batch gives"""
+    await websocket.accept()
+    try:
+        while True:
+            frame = await websocket.receive()
+            if frame['type'] == 'websocket.disconnect':
+                raise WebSocketDisconnect(frame.get('code', 1000))
+            if frame.get('text') is None:
+                await websocket.send_json({'error': 'Frames must be text', 'status': status.HTTP_400_BAD_REQUEST})
+                continue
+            try:
+                body = json.loads(frame['text'])
+                if isinstance(body, dict) or (isinstance(body, list) and all(isinstance(b, str) for b in body)):
+                    result = try_enqueue(websocket, body)
+                else:
+                    result = [try_enqueue(websocket, message) for message in parse_batch(body)]
+            except ValueError:
+                result = {'error': 'Frames must be JSON', 'status': status.HTTP_400_BAD_REQUEST}
+            except HTTPException as e:
+                result = {'error': e.detail, 'status': e.status_code}
+            await websocket.send_json(result)
+    except WebSocketDisconnect:
+        pass
+
 
-    # Get object counts
-    types = objgraph.most_common_types(limit=20)
+@router.get("/events")
+async def events(request: Request):
+    """Server-Sent Events mirroring what's on the LCD"""
+    menu: MainMenu | None = request.app.extra.get('menu')
+    if not menu:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+    return StreamingResponse(
+        menu.mirror.subscribe(),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache'}
+    )
 
-    # Force garbage collection and get counts
-    gc.collect()
 
+@router.get("/queue")
+async def get_queue(request: Request):
+    menu: MainMenu | None = request.app.extra.get('menu')
+    return menu.messages.snapshot() if menu else []
+
+
+@router.post("/scene/{name}")
+async def apply_scene(name: str, request: Request):
+    menu: MainMenu | None = request.app.extra.get('menu')
+    if not menu or name not in menu.kvm.scenes:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"No scene {name}")
+    return await menu.kvm.apply_scene(name)
+
+
+@router.get("/debug/keypad")
+async def keypad_debug(request: Request):
+    keypad: Keypad | None = request.app.extra.get('keypad')
+    if not keypad:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+    menu: MainMenu | None = request.app.extra.get('menu')
     return {
-        "top_memory_allocations": [
-            {
-                "file": stat.traceback[0].filename,
-                "line": stat.traceback[0].lineno,
-                "size": stat.size,
-                "count": stat.count
-            }
-            for stat in top_stats[:10]
-        ],
-        "object_counts": dict(types),
-        "total_tracked_memory": tracemalloc.get_traced_memory()
+        'hooked': keypad.hooked,
+        'latency': keypad.latency.snapshot(),
+        'action_latency': menu.keymap.latency.snapshot() if menu else None
     }
 
+
+@router.get("/debug/lcd")
+async def lcd_debug(request: Request):
+    menu: MainMenu | None = request.app.extra.get('menu')
+    if not menu:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+    return {'glyphs': menu.lcd.glyphs.stats()}
+
+
+@router.get("/debug/startup")
+async def startup_debug(request: Request):
+    startup: Startup | None = request.app.extra.get('startup')
+    if not startup:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+    return startup.report()
+
+
+@router.get("/glyphs")
+async def glyphs():
+    """Custom characters by name, put one in a message to show it"""
+    return {p.name: p.char for p in patterns}
+
+
+@router.get("/health")
+async def health(request: Request):
+    """Each supervised task's state and restarts, 503 unless they're all running (or finished)"""
+    supervisor: Supervisor | None = request.app.extra.get('supervisor')
+    if not supervisor:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+    report = supervisor.health()
+    return JSONResponse(report, status_code=status.HTTP_200_OK if report['ok'] else status.HTTP_503_SERVICE_UNAVAILABLE)
+
+
+@router.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(exposition(), media_type='text/plain; version=0.0.4')
+
+
+@router.get("/telemetry")
+async def get_telemetry(request: Request, resolution: str = '1m', binary: bool = False):
+    """History of each series, oldest first, one sample per step seconds up until end. Binary is each series in turn
+    as little endian float32 (NaN for gaps), with the series names, step and end in headers."""
+    collector: Collector | None = request.app.extra.get('telemetry')
+    if not collector:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+    if resolution not in RESOLUTIONS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Resolution is one of {', '.join(RESOLUTIONS)}")
+    if not binary:
+        return collector.history(resolution)
+    return Response(
+        collector.packed(resolution),
+        media_type='application/octet-stream',
+        headers={
+            'X-Series': ','.join(collector.series),
+            'X-Step': str(RESOLUTIONS[resolution].step),
+            'X-End': str(collector.ends[resolution])
+        }
+    )
+
+
+@router.post("/debug/memory/start")
+async def memory_start():
+    """Starts tracing allocations, later reports are relative to now"""
+    await asyncio.to_thread(memory.start)
+    return {'tracing': True}
+
+
+@router.get("/debug/memory")
+async def memory_debug():
+    return await asyncio.to_thread(memory.report)
+
+
+@router.post("/debug/memory/stop")
+async def memory_stop():
+    """Stops tracing, with a last report"""
+    return await asyncio.to_thread(memory.stop)
+
+
 if __name__ == '__main__':
     import sys
     import uvicorn
@@ -0,0 +1,41 @@
+import asyncio
+import logging
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Callable, TypeVar
+
+T = TypeVar('T')
+
+
+class Startup:
+    """When each phase of bringing the app up started and how long it took, in seconds from this being created.
+    Phases run in threads can overlap, so the report is offsets rather than a running total."""
+
+    def __init__(self):
+        self.began = perf_counter()
+        self.phases: dict[str, tuple[float, float]] = {}
+        self.ready: float | None = None
+
+    @contextmanager
+    def phase(self, name: str):
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = (started - self.began, perf_counter() - started)
+
+    async def thread(self, name: str, fun: Callable[..., T], *args) -> T:
+        with self.phase(name):
+            return await asyncio.to_thread(fun, *args)
+
+    def done(self):
+        self.ready = perf_counter() - self.began
+        for name, (start, took) in sorted(self.phases.items(), key=lambda item: item[1]):
+            logging.info(f'startup {name:<10}{start * 1000:>8.1f}ms +{took * 1000:.1f}ms')
+        logging.info(f'startup ready in {self.ready * 1000:.1f}ms')
+
+    def report(self) -> dict:
+        return {
+            'phases': {name: {'start': start, 'duration': took} for name, (start, took) in self.phases.items()},
+            'ready': self.ready
+        }
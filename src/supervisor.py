@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import random
+import sys
+import threading
+import traceback
+from dataclasses import dataclass, field
+from time import monotonic, sleep, time
+from typing import Any, Awaitable, Callable
+
+from metrics import Counter, loop_lag
+
+BACKOFF_MIN = 1
+BACKOFF_MAX = 5 * 60
+HEALTHY_AFTER = 60  # a task that ran this long before failing starts its backoff over
+HEARTBEAT = .25
+STALL = 1.  # the event loop going this long without a heartbeat gets its stack logged
+
+
+@dataclass
+class Supervised:
+    name: str
+    factory: Callable[[], Awaitable[Any]] = field(repr=False)
+    state: str = 'starting'  # running, backoff, done, failed or cancelled
+    restarts: int = 0
+    failures: int = 0  # in a row, what the backoff is based on
+    last_error: str | None = None
+    started: float = 0.  # wall time
+    retry_at: float | None = None
+    task: asyncio.Task | None = field(default=None, repr=False)
+
+    def describe(self) -> dict:
+        return {
+            'state': self.state,
+            'restarts': self.restarts,
+            'last_error': self.last_error,
+            'up': time() - self.started if self.state == 'running' else None,
+            'retry_at': self.retry_at
+        }
+
+
+class Supervisor:
+    """Keeps long running tasks going, restarting each with exponential backoff and jitter whenever it fails"""
+
+    def __init__(self, backoff_min: float = BACKOFF_MIN, backoff_max: float = BACKOFF_MAX, max_failures: int = None):
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.max_failures = max_failures  # in a row before giving up, None to never give up
+        self.tasks: dict[str, Supervised] = {}
+        self.restarts = Counter('task_restarts_total', 'Supervised tasks restarted after failing')
+
+    def start(self, name: str, factory: Callable[[], Awaitable[Any]]) -> Supervised:
+        """factory is called (again) for a new coroutine every time the task (re)starts"""
+        supervised = self.tasks[name] = Supervised(name, factory)
+        supervised.task = asyncio.create_task(self._run(supervised), name=name)
+        return supervised
+
+    async def _run(self, s: Supervised):
+        while True:
+            s.state = 'running'
+            s.started = time()
+            s.retry_at = None
+            started = monotonic()
+            try:
+                await s.factory()
+                s.state = 'done'
+                return
+            except asyncio.CancelledError:
+                s.state = 'cancelled'
+                raise
+            except Exception as e:
+                s.last_error = repr(e)
+                s.failures = 1 if monotonic() - started > HEALTHY_AFTER else s.failures + 1
+                if self.max_failures is not None and s.failures >= self.max_failures:
+                    s.state = 'failed'
+                    logging.exception(f'{s.name} failed {s.failures} times in a row, giving up')
+                    return
+                delay = min(self.backoff_min * 2 ** (s.failures - 1), self.backoff_max) * random.uniform(.5, 1.5)
+                logging.exception(f'{s.name} failed, restarting in {delay:.1f}s')
+
+            s.state = 'backoff'
+            s.retry_at = time() + delay
+            await asyncio.sleep(delay)
+            s.restarts += 1
+            self.restarts.inc()
+
+    def health(self) -> dict:
+        return {
+            'ok': all(s.state in ('running', 'done') for s in self.tasks.values()),
+            'tasks': {name: s.describe() for name, s in self.tasks.items()}
+        }
+
+    async def stop(self):
+        tasks = [s.task for s in self.tasks.values() if s.task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class Watchdog:
+    """Measures event loop lag with a heartbeat, and from a thread of its own logs where the loop is stuck whenever the
+    heartbeat stops for longer than stall seconds. That stack is whatever's blocking, e.g. a slow ddcutil or GPIO write
+    that should have been in a thread."""
+
+    def __init__(self, stall: float = STALL, heartbeat: float = HEARTBEAT):
+        self.stall = stall
+        self.heartbeat = heartbeat
+        self.beat: float | None = None  # None while not running, so there's nothing to watch
+        self.stalls = Counter('event_loop_stalls_total', f'Times the event loop was blocked for over {stall}s')
+        self._loop_thread: int | None = None
+        self._thread: threading.Thread | None = None
+
+    async def run(self):
+        self._loop_thread = threading.get_ident()
+        if not self._thread or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._watch, name='Watchdog', daemon=True)
+            self._thread.start()
+        try:
+            while True:
+                self.beat = monotonic()
+                await asyncio.sleep(self.heartbeat)
+                loop_lag.observe(max(0., monotonic() - self.beat - self.heartbeat))
+        finally:
+            self.beat = None
+
+    def _watch(self):
+        reported = None
+        while True:
+            sleep(self.stall / 2)
+            beat = self.beat
+            if beat is None or beat == reported or monotonic() - beat < self.stall + self.heartbeat:
+                continue
+            # only once per stall, however long it goes on
+            reported = beat
+            self.stalls.inc()
+            frame = sys._current_frames().get(self._loop_thread)
+            stack = ''.join(traceback.format_stack(frame)) if frame else 'unknown'
+            logging.warning(f'event loop blocked for {monotonic() - beat:.1f}s at\n{stack}')
@@ -1,11 +1,210 @@
-from datetime import datetime
+"""
+Samples the process and the machine it's on every second while the app runs, keeping a fixed window of history at
+each of three resolutions so memory use doesn't grow with uptime. Exporters periodically send a summary elsewhere.
+"""
+import asyncio
+import logging
+import math
+import sys
+from array import array
+from dataclasses import dataclass
+from time import monotonic, time
+from typing import Callable
 
-import httpx
 import psutil
 
+import config
+from metrics import Histogram, loop_lag
+
+THERMAL_ZONE = '/sys/class/thermal/thermal_zone0/temp'
+EXPORT_INTERVAL = 60 * 60
+WEBHOOK_TIMEOUT = 5
+SYSTEM_SERIES = ('cpu', 'rss', 'temperature', 'loop_lag')  # always collected, anything else is up to the app
+
+
+class Ring:
+    """Fixed number of float samples, oldest overwritten first. Slots never written are NaN."""
+    __slots__ = ('data', 'i')
+
+    def __init__(self, size: int):
+        self.data = array('f', [math.nan]) * size
+        self.i = 0  # where the next sample goes, so also the oldest one
+
+    def push(self, value: float):
+        self.data[self.i] = value
+        self.i = (self.i + 1) % len(self.data)
+
+    def ordered(self) -> array:
+        """Oldest first"""
+        return self.data[self.i:] + self.data[:self.i]
+
+
+@dataclass(frozen=True)
+class Resolution:
+    """One sample every step seconds, for the last size steps"""
+    name: str
+    step: int
+    size: int
+
+
+# 10 minutes by the second, a day by the minute and a month by the hour
+RESOLUTIONS = {r.name: r for r in (Resolution('1s', 1, 600), Resolution('1m', 60, 24 * 60), Resolution('1h', 60 * 60, 30 * 24))}
+COARSE = [r for r in RESOLUTIONS.values() if r.step > 1]
+
+
+class Series:
+    """One value sampled every second, averaged down into each coarser resolution as it fills up"""
+    __slots__ = ('rings', 'sums', 'counts')
+
+    def __init__(self):
+        self.rings = {name: Ring(r.size) for name, r in RESOLUTIONS.items()}
+        # running totals for the sample each coarser resolution takes next
+        self.sums = {r.name: 0. for r in COARSE}
+        self.counts = {r.name: 0 for r in COARSE}
+
+    def push(self, value: float, rolled: list[Resolution]):
+        """value goes in at the finest resolution, then each resolution in rolled takes the average since its last"""
+        self.rings['1s'].push(value)
+        if not math.isnan(value):
+            for r in COARSE:
+                self.sums[r.name] += value
+                self.counts[r.name] += 1
+        for r in rolled:
+            self.rings[r.name].push(self.sums[r.name] / self.counts[r.name] if self.counts[r.name] else math.nan)
+            self.sums[r.name] = 0.
+            self.counts[r.name] = 0
+
+
+def temperature() -> float:
+    try:
+        with open(THERMAL_ZONE) as f:
+            return int(f.read()) / 1000
+    except (OSError, ValueError):
+        return math.nan
+
+
+def mean_since_last(histogram: Histogram) -> Callable[[], float]:
+    """The average of what histogram observed between calls, NaN if it observed nothing"""
+    last = [0, 0.]
+
+    def sample() -> float:
+        count, total = histogram.count - last[0], histogram.sum - last[1]
+        last[:] = histogram.count, histogram.sum
+        return total / count if count else math.nan
+
+    return sample
+
+
+class Exporter:
+    async def export(self, collector: 'Collector'):
+        pass
+
+    async def aclose(self):
+        pass
+
+
+class Collector:
+    def __init__(self, samplers: dict[str, Callable[[], float]] = None, exporters: list[Exporter] = None):
+        process = psutil.Process()
+        process.cpu_percent()  # the first reading is always 0, it's relative to the last one
+        self.samplers = {
+            'cpu': process.cpu_percent,
+            'rss': lambda: process.memory_info().rss,
+            'temperature': temperature,
+            'loop_lag': mean_since_last(loop_lag),
+            **(samplers or {})
+        }
+        self.series = {name: Series() for name in self.samplers}
+        self.exporters = exporters or []
+        self._tasks: set[asyncio.Task] = set()  # exports and closes in flight, the loop only keeps weak references
+        self.ticks = 0
+        self.ends = dict.fromkeys(RESOLUTIONS, 0.)  # wall time of the newest sample at each resolution
+
+    def _tick(self) -> list[Resolution]:
+        self.ticks += 1
+        now = time()
+        self.ends['1s'] = now
+        rolled = [r for r in COARSE if self.ticks % r.step == 0]
+        for r in rolled:
+            self.ends[r.name] = now
+        return rolled
+
+    def sample(self):
+        rolled = self._tick()
+        for name, sampler in self.samplers.items():
+            try:
+                value = float(sampler())
+            except Exception:
+                logging.exception(f'sampling {name} failed')
+                value = math.nan
+            self.series[name].push(value, rolled)
+
+    def skip(self):
+        """A second that went by without a sample, e.g. the event loop was blocked"""
+        rolled = self._tick()
+        for series in self.series.values():
+            series.push(math.nan, rolled)
+
+    def history(self, resolution: str) -> dict:
+        """Every series oldest first at resolution, NaN (gaps) as None"""
+        return {
+            'step': RESOLUTIONS[resolution].step,
+            'end': self.ends[resolution],
+            'series': {
+                name: [None if math.isnan(v) else v for v in series.rings[resolution].ordered()]
+                for name, series in self.series.items()
+            }
+        }
+
+    def packed(self, resolution: str) -> bytes:
+        """Every series oldest first at resolution as little endian float32, one after another in series order"""
+        arrays = [series.rings[resolution].ordered() for series in self.series.values()]
+        if sys.byteorder == 'big':
+            for a in arrays:
+                a.byteswap()
+        return b''.join(a.tobytes() for a in arrays)
+
+    async def run(self):
+        started = monotonic()
+        last_export = started
+        while True:
+            self.sample()
+            due = started + self.ticks
+            now = monotonic()
+            while now - due > 1:
+                self.skip()
+                due += 1
+            if self.exporters and now - last_export >= EXPORT_INTERVAL:
+                last_export = now
+                for exporter in self.exporters:
+                    self._spawn(exporter.export(self))
+            await asyncio.sleep(max(0., due - now))
+
+    def _spawn(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._done)
+        return task
+
+    def _done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            logging.warning(f'telemetry exporter failed: {task.exception()!r}')
+
+    def replace_exporters(self, exporters: list[Exporter]):
+        old, self.exporters = self.exporters, exporters
+        for exporter in old:
+            self._spawn(exporter.aclose())
+
+    async def aclose(self):
+        # anything still exporting finishes first, failures are logged by _done
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        for exporter in self.exporters:
+            await exporter.aclose()
+
 
 def generate_bar(percent, size=20):
-    filled = int(percent * size / 100)
+    filled = min(int(percent * size / 100), size)
     return f"[{'■' * filled}{'-' * (size - filled)}]"
 
 
@@ -18,64 +217,44 @@ def format_bytes(bytes):
     return f"{bytes:.1f}TB"
 
 
-def monitor_process():
-    WEBHOOK_URL = "https://discord.com/api/webhooks/1342891815283593318/3bh1fn_AOhPFeC1O-tWE4-1scsWh1K7nMtM8QSRXqlpk-RLObsHfRSqTi-UawqIclm8O"
-
-    # System stats
+def summary(collector: Collector) -> str:
+    """The last hour at a glance, from the per minute series"""
+    mean, peak = {}, {}
+    for name, series in collector.series.items():
+        values = [v for v in series.rings['1m'].ordered()[-60:] if not math.isnan(v)] or [0.]
+        mean[name], peak[name] = sum(values) / len(values), max(values)
     sys_mem = psutil.virtual_memory()
-    sys_cpu = psutil.cpu_percent()
-    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    lines = [
+        f"CPU  : [{mean['cpu']:.1f}%] {generate_bar(mean['cpu'])}",
+        f"RSS  : {format_bytes(mean['rss'])} (peak {format_bytes(peak['rss'])})",
+        f"RAM  : [{sys_mem.percent}%] {generate_bar(sys_mem.percent)} ({sys_mem.used >> 20}/{sys_mem.total >> 20}MB)",
+        f"Temp : {mean['temperature']:.1f}°C (peak {peak['temperature']:.1f}°C)",
+        f"Lag  : {mean['loop_lag'] * 1000:.1f}ms (worst minute {peak['loop_lag'] * 1000:.1f}ms)"
+    ]
+    lines += [f"{name:<5}: {mean[name]:.2f} (peak {peak[name]:.2f})" for name in collector.samplers if name not in SYSTEM_SERIES]
+    return '\n'.join(lines)
 
-    try:
-        # Call the debug endpoint
-        debug_data = httpx.get('http://localhost:1602/debug/memory', timeout=60).json()
-
-        # Format the message
-        message = f"""**Memory Profile** | {timestamp}
-```
-System Resources:
-CPU  : [{sys_cpu}%] {generate_bar(sys_cpu)}
-RAM  : [{sys_mem.percent}%] {generate_bar(sys_mem.percent)} ({sys_mem.used >> 20}/{sys_mem.total >> 20}MB)
-
-Top Memory Allocations:"""
-
-        # Add top memory allocations
-        for alloc in debug_data['top_memory_allocations']:
-            size = format_bytes(alloc['size'])
-            message += f"\n• {alloc['file']}:{alloc['line']} - {size} ({alloc['count']} objects)"
-
-        message += "\n\nObject Counts:"
-        # Add top 5 object counts
-        sorted_objects = sorted(debug_data['object_counts'].items(), key=lambda x: x[1], reverse=True)[:5]
-        for obj_type, count in sorted_objects:
-            message += f"\n• {obj_type}: {count:,}"
-
-        # Add total tracked memory
-        total_tracked = format_bytes(debug_data['total_tracked_memory'][0])
-        peak_tracked = format_bytes(debug_data['total_tracked_memory'][1])
-        message += f"\n\nTotal Tracked Memory: {total_tracked}"
-        message += f"\nPeak Tracked Memory: {peak_tracked}```"
-
-    except httpx.RequestError as e:
-        message = f"""**System Status** | {timestamp}
-```
-ERROR: Could not connect to debug endpoint: {str(e)}
-
-System Resources:
-CPU  : [{sys_cpu}%] {generate_bar(sys_cpu)}
-RAM  : [{sys_mem.percent}%] {generate_bar(sys_mem.percent)} ({sys_mem.used >> 20}/{sys_mem.total >> 20}MB)
-```"""
-
-    # Send to Discord
-    try:
-        httpx.post(
-            WEBHOOK_URL,
-            json={"content": message},
-            timeout=5
-        )
-    except httpx.RequestError as e:
-        print(f"Failed to send to Discord: {e}")
+
+class WebhookExporter(Exporter):
+    """Posts the summary as {"content": ...}, which is what Discord and Slack style webhooks take"""
+
+    def __init__(self, url: str, transport=None):
+        # httpx is only needed once something's exported
+        import httpx
+        self.url = url
+        self.client = httpx.AsyncClient(timeout=WEBHOOK_TIMEOUT, transport=transport)
+
+    async def export(self, collector: Collector):
+        content = f"**Monitor Control** | last hour\n```\n{summary(collector)}\n```"
+        try:
+            response = await self.client.post(self.url, json={'content': content})
+            response.raise_for_status()
+        except Exception as e:
+            logging.warning(f'telemetry webhook failed: {e!r}')
+
+    async def aclose(self):
+        await self.client.aclose()
 
 
-if __name__ == "__main__":
-    monitor_process()
+def exporters_from_config(cfg: config.Config) -> list[Exporter]:
+    return [WebhookExporter(cfg.telemetry.webhook)] if cfg.telemetry.webhook else []
@@ -1,108 +1,93 @@
-import asyncio
-import logging
-import os
 from datetime import datetime
-from pprint import pformat
 from time import time
 
-import httpx
-
-from frame import MenuFrame, Menu
-from lcd import Align, Msg, time_str
+import config
+from forecast import Forecast
+from fmt import fit, spread, time_str, wind_dir
+from frame import MenuEntry, MenuFrame, Menu
+from lcd import Align, Msg
 from patterns import FAHRENHEIT, MOON, SUN
-
-directions = ['N', 'NNE', 'NE', 'ENE', 'E', 'ESE', 'SE', 'SSE', 'S', 'SSW', 'SW', 'WSW', 'W', 'WNW', 'NW', 'NNW']
-
-
-def wind_dir(degrees: int) -> str:
-    if degrees >= 360:
-        degrees = degrees % 360
-    return next(d for i, d in enumerate(directions) if abs(degrees - (i * 22.5)) % (360 - 11.25) < 11.25)
+from weather_api import CURRENT, FORECAST, WeatherAPI
 
 
 class Weather(MenuFrame):
-    def __init__(self, menu: Menu):
+    bindings = {**MenuFrame.bindings, '#': 'open_forecast'}
+
+    def __init__(self, menu: Menu, api: WeatherAPI = None):
         self.lcd = menu.lcd
-        weather_key = os.environ.get('OPEN_WEATHER_API_KEY')
-        lat = os.environ.get('LAT')
-        lon = os.environ.get('LON')
-        self.invalid = any(i is None for i in [weather_key, lat, lon])
-        open_weather_url = "https://api.openweathermap.org/data"
-        url_params = f"lat={lat}&lon={lon}&appid={weather_key}&units=imperial"
-        self.current_url = f"{open_weather_url}/2.5/weather?{url_params}"
-        self.forecast_url = f"{open_weather_url}/2.5/forecast?{url_params}"
-        self.detailed_forecast_url = f"{open_weather_url}/3.0/onecall?{url_params}"
+        self.api = api or WeatherAPI.from_config(config.current().weather)
+        self.api.on_update = self.on_update
+        self.invalid = self.api.invalid
 
         self.temperature = ''
         self.conditions = ''
         self.sun = ''
         self.wind_speed = ''
         self.wind_dir = ''
+        # until there's some weather to show, which without a key and location is never
+        self.line_two = f"{'Bad Weather Conf' if self.invalid else 'Weather Loading':>16}"
 
-        msg = Msg(
-            time_str(datetime.now()),
-            'Bad Weather Conf' if self.invalid else 'Weather Loading', Align.LEFT, Align.RIGHT
-        )
-        asyncio.create_task(self.update_weather())
-        super().__init__(menu, msg)
+        super().__init__(menu, Msg(time_str(datetime.now()), self.line_two, Align.LEFT, Align.RIGHT))
+        self.forecast: Forecast | None = None
+        if current := self.api.peek(CURRENT):
+            self.parse_current(current)
+
+    @classmethod
+    def from_entry(cls, menu: Menu, entry: MenuEntry) -> 'Weather':
+        return cls(menu, menu.weather)
 
     def activate(self):
         super().activate()
-        asyncio.create_task(self.update_weather())
+        # show what's cached straight away, on_update redraws if the refresh brings anything new
+        self.tick(datetime.now())
 
-    def todays_forecast(self):
-        fore = httpx.get(self.forecast_url).json()
-        today = datetime.now().day
-        return [f for f in fore['list'] if datetime.fromtimestamp(int(f['dt'])).day == today]
-
-    async def update_weather(self):
+    def tick(self, now: datetime):
+        # the clock keeps going either way
+        self.update_msg(now)
         if self.invalid:
             return
-        async with httpx.AsyncClient() as client:
-            res = await client.get(self.current_url)
-            now = datetime.now()
-            if res.is_success:
-                w = res.json()
-                self.temperature = f"{round(w['main']['temp'])}{FAHRENHEIT}"
-                self.conditions = w['weather'][0]['main']
-                self.wind_speed = f"{round(w['wind']['speed'])}mph"
-                self.wind_dir = wind_dir(w['wind']['deg']) if int(w['wind']['speed']) else ''
-
-                sun_ts, sun_symbol = (
-                    w['sys']['sunset'], MOON
-                ) if (w['sys']['sunrise'] < now.timestamp() < w['sys']['sunset']) else (
-                    w['sys']['sunrise'], SUN
-                )
-                self.sun = f"{sun_symbol}{time_str(datetime.fromtimestamp(sun_ts))}"
-            else:
-                logging.exception(pformat(res.__dict__))
-
-            self.update_msg(now)
-
-    async def get_forecast(self):
-        async with httpx.AsyncClient() as client:
-            res = await client.get(self.forecast_url)
+        for path in (CURRENT, FORECAST):
+            if self.api.stale(path):
+                self.api.revalidate(path)
+
+    def unload(self):
+        self.api.on_update = lambda path, data: None
+        if self.forecast:
+            self.forecast.unload()
+
+    def open_forecast(self):
+        if not self.forecast:
+            self.forecast = Forecast(self.menu, self.api)
+        self.menu.push(self.forecast)
+        self.menu.apply(self.forecast)
+
+    def on_update(self, path: str, data: dict):
+        if path == CURRENT:
+            self.parse_current(data)
+            self.update_msg(datetime.now())
+        elif path == FORECAST and self.forecast:
+            self.forecast.load_soon(data)
+
+    def parse_current(self, w: dict):
+        self.temperature = f"{round(w['main']['temp'])}{FAHRENHEIT}"
+        self.conditions = w['weather'][0]['main']
+        self.wind_speed = f"{round(w['wind']['speed'])}mph"
+        self.wind_dir = wind_dir(w['wind']['deg']) if int(w['wind']['speed']) else ''
+
+        sun_ts, sun_symbol = (
+            w['sys']['sunset'], MOON
+        ) if (w['sys']['sunrise'] < time() < w['sys']['sunset']) else (
+            w['sys']['sunrise'], SUN
+        )
+        self.sun = f"{sun_symbol}{time_str(datetime.fromtimestamp(sun_ts))}"
+        # only changes with the weather, no need to lay it out again every minute
+        self.line_two = fit(
+            spread(f"{self.wind_speed} {self.wind_dir}".rstrip(), self.sun), spread(self.wind_speed, self.sun)
+        )
 
     def update_msg(self, dt: datetime):
         ts = time_str(dt)
-        s1 = max(0, 16 - (len(ts) + len(self.temperature) + len(self.conditions)))
-        line_one = f"{ts}{' ' * (int(s1 / 2) + s1 % 2)}{self.temperature}{' ' * int(s1 / 2)}{self.conditions}"
-
-        s2 = 16 - (len(self.wind_speed) + len(self.wind_dir) + len(self.sun))
-
-        s21 = int(s2 > 1)
-        s22 = s2 - s21
-        line_two = f"{self.wind_speed}{' ' * s21}{self.wind_dir}{' ' * s22}{self.sun}"
-
-        self.msg = Msg(line_one, line_two)
+        line_one = fit(spread(ts, self.temperature, self.conditions), spread(ts, self.temperature))
+        self.msg = Msg(line_one, self.line_two)
         if self.active:
-            self.lcd.msg(self.msg)
-
-    async def __call__(self):
-        while True:
-            await asyncio.sleep(60 - time() % 60)
-            now = datetime.now()
-            if now.minute % 15:
-                self.update_msg(now)
-            else:
-                await self.update_weather()
+            self.lcd.show(self.msg)
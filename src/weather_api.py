@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import random
+from dataclasses import dataclass
+from time import monotonic
+from typing import Callable
+
+import httpx
+
+import config
+
+OPEN_WEATHER_URL = "https://api.openweathermap.org/data"
+CURRENT = '/2.5/weather'
+FORECAST = '/2.5/forecast'
+
+# OpenWeather recalculates current conditions about every 10 minutes and the forecast every few hours
+TTLS = {CURRENT: 10 * 60, FORECAST: 60 * 60}
+BACKOFF_MIN = 30
+BACKOFF_MAX = 30 * 60
+
+
+@dataclass
+class Entry:
+    data: dict | None = None
+    fetched: float = float('-inf')
+    etag: str | None = None
+    last_modified: str | None = None
+    failures: int = 0
+    retry_at: float = 0.
+    refreshing: asyncio.Task | None = None
+
+
+class WeatherAPI:
+    """One pooled client for OpenWeather with a per-endpoint TTL cache.
+
+    Menu code reads through get(), which hands back whatever is cached and revalidates stale entries in the
+    background, so navigating never waits on the network. Refreshes send conditional headers and back off
+    exponentially (with jitter) after failures."""
+
+    def __init__(self, key: str | None, lat: str | None, lon: str | None, base_url: str = OPEN_WEATHER_URL):
+        self.client = httpx.AsyncClient(timeout=10, limits=httpx.Limits(max_connections=2, max_keepalive_connections=2))
+        self.on_update: Callable[[str, dict], None] = lambda path, data: None
+        self._entries: dict[str, Entry] = {}
+        self.configure(key, lat, lon, base_url)
+
+    @classmethod
+    def from_config(cls, weather: config.WeatherConfig) -> 'WeatherAPI':
+        return cls(weather.key, weather.lat, weather.lon, weather.url or OPEN_WEATHER_URL)
+
+    def reconfigure(self, weather: config.WeatherConfig):
+        self.configure(weather.key, weather.lat, weather.lon, weather.url or OPEN_WEATHER_URL)
+
+    def configure(self, key: str | None, lat: str | None, lon: str | None, base_url: str = OPEN_WEATHER_URL):
+        """Point at a different place or server, dropping everything cached for the old one. Anything that was
+        cached is fetched again straight away and handed to on_update as usual."""
+        self.invalid = any(i is None for i in [key, lat, lon])
+        self.client.base_url = base_url
+        self.client.params = {'lat': lat, 'lon': lon, 'appid': key, 'units': 'imperial'}
+        paths = list(self._entries)
+        for entry in self._entries.values():
+            if entry.refreshing:
+                entry.refreshing.cancel()
+        self._entries.clear()
+        for path in paths:
+            self.revalidate(path)
+
+    def _entry(self, path: str) -> Entry:
+        return self._entries.setdefault(path, Entry())
+
+    def peek(self, path: str) -> dict | None:
+        """Whatever is cached, however old, without any I/O"""
+        return self._entry(path).data
+
+    def stale(self, path: str) -> bool:
+        return monotonic() - self._entry(path).fetched > TTLS.get(path, TTLS[CURRENT])
+
+    async def get(self, path: str, wait: bool = False) -> dict | None:
+        """Cached data for path. Nothing cached yet, or wait, means stale data is refreshed before returning,
+        otherwise a stale entry is returned as is while it refreshes in the background."""
+        entry = self._entry(path)
+        if not self.stale(path):
+            return entry.data
+        if entry.data is None or wait:
+            return await self.refresh(path)
+        self.revalidate(path)
+        return entry.data
+
+    def revalidate(self, path: str) -> asyncio.Task | None:
+        """Start refreshing path in the background unless it already is or is backing off"""
+        entry = self._entry(path)
+        if not entry.refreshing and not self.invalid and monotonic() >= entry.retry_at:
+            entry.refreshing = asyncio.create_task(self._fetch(path, entry))
+            entry.refreshing.add_done_callback(lambda _: setattr(entry, 'refreshing', None))
+        return entry.refreshing
+
+    async def refresh(self, path: str) -> dict | None:
+        task = self.revalidate(path)
+        # shielded so a cancelled caller doesn't abort a fetch others may be waiting on
+        return await asyncio.shield(task) if task else self._entry(path).data
+
+    async def _fetch(self, path: str, entry: Entry) -> dict | None:
+        headers = {}
+        if entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+
+        try:
+            res = await self.client.get(path, headers=headers)
+        except httpx.HTTPError as e:
+            return self._fail(path, entry, repr(e))
+
+        if res.status_code == httpx.codes.NOT_MODIFIED and entry.data is not None:
+            entry.fetched = monotonic()
+            entry.failures = 0
+            return entry.data
+        if not res.is_success:
+            return self._fail(path, entry, f'{res.status_code} {res.text[:200]}')
+
+        try:
+            entry.data = res.json()
+        except ValueError as e:
+            return self._fail(path, entry, repr(e))
+        entry.fetched = monotonic()
+        entry.failures = 0
+        entry.etag = res.headers.get('ETag')
+        entry.last_modified = res.headers.get('Last-Modified')
+        self.on_update(path, entry.data)
+        return entry.data
+
+    def _fail(self, path: str, entry: Entry, reason: str) -> dict | None:
+        entry.failures += 1
+        delay = min(BACKOFF_MIN * 2 ** (entry.failures - 1), BACKOFF_MAX) * random.uniform(.5, 1.5)
+        entry.retry_at = monotonic() + delay
+        logging.warning(f'{path} failed ({reason}), retrying in {delay:.0f}s')
+        return entry.data
+
+    async def aclose(self):
+        await self.client.aclose()
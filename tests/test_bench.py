@@ -0,0 +1,11 @@
+import asyncio
+
+import pytest
+
+from bench import SCENARIOS, over_budget
+
+
+@pytest.mark.parametrize('name', SCENARIOS)
+def test_scenario_within_budget(name):
+    results = asyncio.run(SCENARIOS[name](realtime=False))
+    assert over_budget(name, results) == []
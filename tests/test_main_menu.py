@@ -0,0 +1,17 @@
+import asyncio
+
+from bench import Simulation
+from fakes import taps
+
+
+def test_toast_after_dismissing_the_same_toast():
+    """Dismissing a toast with * and then bringing the same one back shows it again, instead of extending the one that
+    isn't on screen any more"""
+    async def run():
+        async with Simulation(realtime=False) as sim:
+            # to the main menu, next input, dismiss its toast, back to the first input and then the next one again
+            await sim.play(taps(['8', 'D', '*', 'C', 'D'], start=.1, gap=.3))
+            return sim.display.lines()[1].decode().strip(), sim.menu.kvm.current_display.label
+
+    shown, current = asyncio.run(run())
+    assert shown == current
@@ -0,0 +1,42 @@
+from types import SimpleNamespace
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import server
+from messages import MessageQueue
+from patterns import patterns
+
+# one more glyph than the display holds at once
+TOO_MANY_GLYPHS = ''.join(p.char for p in patterns[:9])
+
+
+@pytest.fixture
+def client():
+    app = FastAPI(menu=SimpleNamespace(messages=MessageQueue()))
+    app.include_router(server.router)
+    with TestClient(app) as client:
+        yield client
+
+
+def test_post_too_many_glyphs(client):
+    response = client.post('/', json=[TOO_MANY_GLYPHS, ''])
+    assert response.status_code == 400
+    assert 'Max 8 symbols' in response.json()['detail']
+
+
+def test_batch_rejects_only_the_bad_message(client):
+    response = client.post('/batch', json=[['fine', ''], [TOO_MANY_GLYPHS, ''], ['also fine', '']])
+    assert response.status_code == 200
+    good, bad, also_good = response.json()
+    assert 'error' not in good and 'error' not in also_good
+    assert bad['status'] == 400 and 'Max 8 symbols' in bad['error']
+
+
+def test_websocket_reports_too_many_glyphs(client):
+    with client.websocket_connect('/ws') as ws:
+        ws.send_json([TOO_MANY_GLYPHS, ''])
+        result = ws.receive_json()
+    assert result['status'] == 400
+    assert 'Max 8 symbols' in result['error']
@@ -0,0 +1,58 @@
+import asyncio
+import json
+
+import httpx
+
+from telemetrics import Collector, WebhookExporter
+
+
+def test_webhook_posts_summary():
+    posted = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        posted.append((str(request.url), json.loads(request.content)))
+        return httpx.Response(204)
+
+    async def run():
+        collector = Collector({'queue': lambda: 3})
+        for _ in range(120):
+            collector.sample()
+        exporter = WebhookExporter('https://hooks.example/abc', transport=httpx.MockTransport(handler))
+        await exporter.export(collector)
+        await exporter.aclose()
+
+    asyncio.run(run())
+    [(url, body)] = posted
+    assert url == 'https://hooks.example/abc'
+    assert 'last hour' in body['content']
+    assert 'queue: 3.00' in body['content']
+
+
+def test_webhook_failure_is_logged_not_raised(caplog):
+    async def run():
+        transport = httpx.MockTransport(lambda request: httpx.Response(500))
+        exporter = WebhookExporter('https://hooks.example/abc', transport=transport)
+        await exporter.export(Collector())
+        await exporter.aclose()
+
+    asyncio.run(run())
+    assert 'telemetry webhook failed' in caplog.text
+
+
+def test_aclose_waits_for_exports_in_flight():
+    finished = []
+
+    class Slow(WebhookExporter):
+        async def export(self, collector):
+            await asyncio.sleep(.05)
+            finished.append(True)
+
+    async def run():
+        exporter = Slow('https://hooks.example/abc', transport=httpx.MockTransport(lambda r: httpx.Response(204)))
+        collector = Collector(exporters=[exporter])
+        collector._spawn(exporter.export(collector))
+        await collector.aclose()
+        assert not collector._tasks
+
+    asyncio.run(run())
+    assert finished == [True]